@@ -0,0 +1,101 @@
+import os
+import gzip
+import json
+import fcntl
+import logging
+import datetime
+import threading
+
+class Archive(object):
+    '''Append-only store of raw atlas results, one gzip file of json lines per
+    measurement and day: {directory}/{msm_id}/{YYYY-MM-DD}.jsonl.gz.  Each
+    write appends a new gzip member so files are never rewritten.  Files are
+    locked while a member is written so processes can share the directory'''
+
+    def __init__(self, directory='archive', batch_size=1000):
+        '''initialise class'''
+        self.logger     = logging.getLogger('atlas-kibana.Archive')
+        self.directory  = directory
+        self.batch_size = batch_size
+        self.lock       = threading.Lock()
+
+    @staticmethod
+    def _day(timestamp):
+        '''return the partition name of a unix timestamp'''
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+    def _path(self, measurement_id, day):
+        '''return the file holding a measurement day'''
+        return os.path.join(self.directory, str(measurement_id), '{}.jsonl.gz'.format(day))
+
+    def _key(self, result):
+        '''return the (measurement id, day) partition of a raw result'''
+        return result.get('msm_id', None), self._day(result.get('timestamp', 0))
+
+    def _append(self, lines):
+        '''append a list of (partition, json line) to the archive files'''
+        partitions = dict()
+        for key, line in lines:
+            partitions.setdefault(key, []).append(line)
+        with self.lock:
+            for (measurement_id, day), lines in partitions.items():
+                path = self._path(measurement_id, day)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'ab') as raw_file:
+                    fcntl.flock(raw_file, fcntl.LOCK_EX)
+                    archive_file = gzip.GzipFile(fileobj=raw_file, mode='ab')
+                    archive_file.write('\n'.join(lines) + '\n')
+                    # closing the gzip file flushes the member, the lock goes with raw_file
+                    archive_file.close()
+
+    def write(self, results):
+        '''append a list of raw results to their partitions'''
+        self._append([(self._key(result), json.dumps(result)) for result in results])
+
+    def record(self, results):
+        '''yield results, appending them to the archive in batches.  results are
+        serialised before they are yielded as parsing modifies them'''
+        lines = []
+        for result in results:
+            lines.append((self._key(result), json.dumps(result)))
+            if len(lines) >= self.batch_size:
+                self._append(lines)
+                lines = []
+            yield result
+        if lines:
+            self._append(lines)
+
+    def days(self, measurement_id, start=None, stop=None):
+        '''return the archived days of a measurement between start and stop in order'''
+        directory = os.path.join(self.directory, str(measurement_id))
+        if not os.path.isdir(directory):
+            return []
+        first = self._day(start) if start is not None else None
+        last  = self._day(stop) if stop is not None else None
+        days  = []
+        for name in os.listdir(directory):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            day = name[:-len('.jsonl.gz')]
+            if (first is None or day >= first) and (last is None or day <= last):
+                days.append(day)
+        return sorted(days)
+
+    def read(self, measurement_id, start=None, stop=None):
+        '''yield the archived raw results of a measurement with a timestamp
+        between start and stop inclusive'''
+        for day in self.days(measurement_id, start, stop):
+            path = self._path(measurement_id, day)
+            self.logger.info('{}: replaying {}'.format(measurement_id, path))
+            try:
+                with gzip.open(path, 'rb') as archive_file:
+                    for line in archive_file:
+                        result    = json.loads(line)
+                        timestamp = result.get('timestamp', 0)
+                        if (start is None or timestamp >= start) and (stop is None or timestamp <= stop):
+                            yield result
+            except (IOError, EOFError, ValueError) as e:
+                # a write interrupted by a crash leaves a truncated last member
+                self.logger.error('{}: unable to read the rest of {}: {}'.format(
+                    measurement_id, path, e))
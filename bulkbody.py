@@ -0,0 +1,106 @@
+import json
+import logging
+import datetime
+import probe
+
+'''
+Build elasticsearch bulk request bodies as newline delimited json.  ujson is
+used to encode documents when it is installed, anything it can not encode
+falls back to the standard library encoder.  Probe fragments are spliced into
+documents from their precomputed encoding
+'''
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# action keys which go into the bulk action line rather than the document
+META_FIELDS = ('_index', '_type', '_id', '_routing', '_version', '_parent')
+
+def _default(value):
+    '''encode the values the standard library can not'''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+def _stdlib_dumps(value):
+    '''encode a value with the standard library'''
+    return json.dumps(value, separators=(',', ':'), default=_default)
+
+def dumps(value):
+    '''encode a value as compact json with the fastest available encoder'''
+    if ujson is not None:
+        try:
+            return ujson.dumps(value)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return _stdlib_dumps(value)
+
+
+class BulkBody(object):
+    '''Pack encoded bulk items into bulk request bodies of at most sizer.size
+    actions and max_bytes bytes.  The line buffer is reused between bodies'''
+
+    def __init__(self, sizer, max_bytes=10485760):
+        '''initialise class'''
+        self.logger    = logging.getLogger('atlas-kibana.BulkBody')
+        self.max_bytes = max_bytes
+        self.sizer     = sizer
+        self.lines     = []
+        self.items     = []
+        self.size      = 0
+
+    @staticmethod
+    def encode(action):
+        '''return the bulk item of an index action, a tuple of
+        (op type, metadata, action line, document line)'''
+        op_type = action.get('_op_type', 'index')
+        meta    = dict()
+        source  = dict()
+        for key, value in action.iteritems():
+            if key in META_FIELDS:
+                meta[key] = value
+            elif key != '_op_type':
+                source[key] = value
+        fragment = source.get('probe', None)
+        if isinstance(fragment, probe.Fragment):
+            del source['probe']
+            document = dumps(source)
+            document = '{}{}"probe":{}}}'.format(document[:-1],
+                    ',' if len(document) > 2 else '', fragment.json)
+        else:
+            document = dumps(source)
+        return op_type, meta, dumps({op_type: meta}), document
+
+    @staticmethod
+    def join(items):
+        '''return the bulk request body of a list of bulk items'''
+        lines = []
+        for op_type, meta, header, document in items:
+            lines.append(header)
+            lines.append(document)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _take(self):
+        '''return the buffered (body, items) and empty the buffer'''
+        self.lines.append('')
+        body, items = '\n'.join(self.lines), self.items
+        del self.lines[:]
+        self.items = []
+        self.size  = 0
+        return body, items
+
+    def pack(self, items):
+        '''yield a (body, list of bulk items) per bulk request'''
+        for item in items:
+            size = len(item[2]) + len(item[3]) + 2
+            if self.items and (len(self.items) >= self.sizer.size or self.size + size > self.max_bytes):
+                yield self._take()
+            self.lines.append(item[2])
+            self.lines.append(item[3])
+            self.items.append(item)
+            self.size += size
+        if self.items:
+            yield self._take()
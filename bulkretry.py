@@ -0,0 +1,81 @@
+import json
+import logging
+import threading
+import bulkbody
+
+# statuses of bulk items and requests which elasticsearch may accept later
+RETRY_STATUS = frozenset([429, 503])
+
+class BulkSizer(object):
+    '''Adapt the number of actions per bulk request to how busy elasticsearch
+    is.  The size is halved when elasticsearch rejects work and grows back by
+    a tenth after each request which was not rejected, up to maximum'''
+
+    def __init__(self, maximum=200, minimum=10):
+        '''initialise class'''
+        self.logger  = logging.getLogger('atlas-kibana.BulkSizer')
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.size    = maximum
+        self.lock    = threading.Lock()
+
+    def shrink(self):
+        '''elasticsearch rejected work, send less per request'''
+        with self.lock:
+            size = max(self.size // 2, self.minimum)
+            if size != self.size:
+                self.logger.warning('elasticsearch is rejecting requests, bulk size {} -> {}'.format(
+                    self.size, size))
+            self.size = size
+
+    def grow(self):
+        '''a request went through, send a little more per request'''
+        with self.lock:
+            self.size = min(self.size + max(self.size // 10, 1), self.maximum)
+
+
+def error_message(error):
+    '''return a one line description of a bulk item error'''
+    if isinstance(error, dict):
+        return '{}: {}'.format(error.get('type', None), error.get('reason', None))
+    return str(error)
+
+
+class DeadLetter(object):
+    '''Append bulk items which could not be indexed to a json lines file, one
+    {"status", "error", "action", "source"} object per item.  The action and
+    source are written from the encoded bulk lines so they are not encoded
+    again'''
+
+    def __init__(self, path, max_error=200):
+        '''initialise class'''
+        self.logger    = logging.getLogger('atlas-kibana.DeadLetter')
+        self.path      = path
+        self.max_error = max_error
+        self.lock      = threading.Lock()
+        self.count     = 0
+
+    def write(self, failed):
+        '''append a list of (bulk item, status, error message)'''
+        if not failed:
+            return
+        lines = []
+        for (op_type, meta, header, document), status, error in failed:
+            lines.append('{{"status":{},"error":{},"action":{},"source":{}}}'.format(
+                bulkbody.dumps(status), bulkbody.dumps(error[:self.max_error]), header, document))
+        with self.lock:
+            with open(self.path, 'ab') as dead_letter:
+                dead_letter.write('\n'.join(lines) + '\n')
+            self.count += len(lines)
+
+    @staticmethod
+    def read(path):
+        '''yield the bulk items of a dead letter file'''
+        with open(path, 'rb') as dead_letter:
+            for line in dead_letter:
+                if not line.strip():
+                    continue
+                record        = json.loads(line)
+                op_type, meta = record['action'].items()[0]
+                yield (op_type, meta, bulkbody.dumps(record['action']),
+                        bulkbody.dumps(record['source']))
@@ -0,0 +1,123 @@
+import time
+import json
+import sqlite3
+import logging
+import threading
+import collections
+
+class Cache(object):
+    '''Two level (in memory LRU and on disk sqlite) cache with a TTL per entry.
+    Entries are keyed by (call, resource) and values must be json serialisable'''
+
+    def __init__(self, cache_file='enrich-cache.db', ttl=604800, size=4096, ttls=None):
+        '''initialise class'''
+        self.logger     = logging.getLogger('atlas-kibana.Cache')
+        self.cache_file = cache_file
+        self.ttl        = ttl
+        self.ttls       = ttls or dict()
+        self.size       = size
+        self.lock       = threading.Lock()
+        self.memory     = collections.OrderedDict()
+        self.pending    = dict()
+        self.hits       = 0
+        self.misses     = 0
+        self.db         = None
+        if self.cache_file:
+            self._open()
+
+    def _open(self):
+        '''open the on disk cache'''
+        try:
+            self.db = sqlite3.connect(self.cache_file, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                    'call TEXT, resource TEXT, expires INTEGER, value TEXT, '
+                    'PRIMARY KEY (call, resource))')
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.logger.warning('unable to open cache file {}: {}'.format(self.cache_file, e))
+            self.db = None
+
+    def _memory_get(self, key, now):
+        '''get an entry from the LRU, caller must hold the lock'''
+        expires, value = self.memory.pop(key)
+        if expires < now:
+            raise KeyError(key)
+        self.memory[key] = (expires, value)
+        return value
+
+    def _memory_set(self, key, expires, value):
+        '''set an entry in the LRU, caller must hold the lock'''
+        self.memory.pop(key, None)
+        self.memory[key] = (expires, value)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get(self, call, resource):
+        '''return the cached value, raises KeyError if it is missing or expired'''
+        key = (call, str(resource))
+        now = time.time()
+        with self.lock:
+            try:
+                value = self._memory_get(key, now)
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+            if self.db is not None:
+                row = self.db.execute('SELECT expires, value FROM cache WHERE call = ? AND resource = ?',
+                        key).fetchone()
+                if row and row[0] >= now:
+                    value = json.loads(row[1])
+                    self._memory_set(key, row[0], value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        raise KeyError(key)
+
+    def set(self, call, resource, value, ttl=None):
+        '''store a value'''
+        key     = (call, str(resource))
+        expires = int(time.time() + (ttl or self.ttls.get(call, self.ttl)))
+        with self.lock:
+            self._memory_set(key, expires, value)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                        key + (expires, json.dumps(value)))
+                self.db.commit()
+
+    def fetch(self, call, resource, fetcher, ttl=None):
+        '''return the cached value or call fetcher() and cache the result.
+        concurrent callers for the same key wait for the first one to finish'''
+        try:
+            return self.get(call, resource)
+        except KeyError:
+            pass
+        key = (call, str(resource))
+        with self.lock:
+            pending = self.pending.setdefault(key, threading.Lock())
+        with pending:
+            try:
+                return self.get(call, resource)
+            except KeyError:
+                pass
+            value = fetcher()
+            if value is not None:
+                self.set(call, resource, value, ttl)
+        with self.lock:
+            self.pending.pop(key, None)
+        return value
+
+    def purge(self):
+        '''remove expired entries from the on disk cache'''
+        with self.lock:
+            if self.db is not None:
+                self.db.execute('DELETE FROM cache WHERE expires < ?', (int(time.time()),))
+                self.db.commit()
+
+    def close(self):
+        '''close the on disk cache'''
+        self.logger.info('cache hits: {} misses: {}'.format(self.hits, self.misses))
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,153 @@
+import os
+import json
+import logging
+import threading
+
+class Checkpoint(object):
+    '''Record which time windows of a measurement have been fully indexed and
+    which failed, so an interrupted backfill can be resumed.  Windows are
+    inclusive [start, stop] pairs, the next window starts at stop + 1'''
+
+    def __init__(self, measurement_id, directory='checkpoints', start_time=None):
+        '''initialise class'''
+        self.logger          = logging.getLogger('atlas-kibana.Checkpoint')
+        self.measurement_id  = measurement_id
+        self.directory       = directory
+        self.checkpoint_file = os.path.join(directory, '{}.json'.format(measurement_id))
+        self.lock            = threading.Lock()
+        self.start_time      = start_time
+        self.completed       = []
+        self.failed          = []
+
+    def load(self):
+        '''load the checkpoint file, returns False if there is none'''
+        try:
+            with open(self.checkpoint_file) as checkpoint:
+                data = json.load(checkpoint)
+        except IOError:
+            return False
+        except ValueError as e:
+            self.logger.error('{}: ignoring corrupt checkpoint {}: {}'.format(
+                self.measurement_id, self.checkpoint_file, e))
+            return False
+        self.start_time = data.get('start_time', self.start_time)
+        self.completed  = [tuple(window) for window in data.get('completed', [])]
+        self.failed     = [tuple(window) for window in data.get('failed', [])]
+        self.logger.info('{}: resuming, indexed until {} with {} failed chunks'.format(
+            self.measurement_id, self.indexed_until, len(self.failed)))
+        return True
+
+    def save(self):
+        '''write the checkpoint file, caller must hold the lock'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_file = '{}.tmp'.format(self.checkpoint_file)
+        with open(tmp_file, 'w') as checkpoint:
+            json.dump({
+                'measurement_id': self.measurement_id,
+                'start_time'    : self.start_time,
+                'indexed_until' : self.indexed_until,
+                'completed'     : self.completed,
+                'failed'        : self.failed }, checkpoint, indent=1)
+        os.rename(tmp_file, self.checkpoint_file)
+
+    @property
+    def indexed_until(self):
+        '''the end of the contiguous indexed range from start_time or None'''
+        if self.completed and self.start_time is not None and self.completed[0][0] <= self.start_time:
+            return self.completed[0][1]
+        return None
+
+    def is_completed(self, start, stop):
+        '''check if a window is inside an indexed range'''
+        for first, last in self.completed:
+            if first <= start and stop <= last:
+                return True
+        return False
+
+    def skip_completed(self, start, windows=()):
+        '''return the first time from start which is not inside an indexed range
+        or one of windows'''
+        skipped = True
+        while skipped:
+            skipped = False
+            for first, last in self.completed + list(windows):
+                if first <= start <= last:
+                    start   = last + 1
+                    skipped = True
+        return start
+
+    def _merge(self, start, stop):
+        '''add a window to the completed ranges, merging adjacent ranges'''
+        merged = []
+        for first, last in sorted(self.completed + [(start, stop)]):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        self.completed = merged
+
+    def complete(self, start, stop):
+        '''mark a window as fully indexed'''
+        with self.lock:
+            self._merge(start, stop)
+            if (start, stop) in self.failed:
+                self.failed.remove((start, stop))
+            self.save()
+
+    def fail(self, start, stop):
+        '''mark a window as failed'''
+        self.logger.error('{}: chunk {} - {} failed'.format(self.measurement_id, start, stop))
+        with self.lock:
+            if (start, stop) not in self.failed:
+                self.failed.append((start, stop))
+            self.save()
+
+
+class ChunkState(object):
+    '''Track the batches of one time window through the parse and index stages
+    and report the window to its checkpoint once every batch is done'''
+
+    def __init__(self, measurement_id, start, stop, checkpoint=None):
+        '''initialise class'''
+        self.measurement_id = measurement_id
+        self.start          = start
+        self.stop           = stop
+        self.checkpoint     = checkpoint
+        self.lock           = threading.Lock()
+        self.pending        = 0
+        self.parsed         = False
+        self.ok             = True
+        self.reported       = False
+
+    def add_batch(self):
+        '''a batch of the window was handed to the index stage'''
+        with self.lock:
+            self.pending += 1
+
+    def batch_done(self, ok):
+        '''a batch of the window was indexed'''
+        with self.lock:
+            self.pending -= 1
+            self.ok       = self.ok and ok
+        self._report()
+
+    def parse_done(self, ok):
+        '''all batches of the window have been handed to the index stage'''
+        with self.lock:
+            self.parsed = True
+            self.ok     = self.ok and ok
+        self._report()
+
+    def _report(self):
+        '''tell the checkpoint about the window once it is finished'''
+        with self.lock:
+            if self.reported or not self.parsed or self.pending:
+                return
+            self.reported = True
+        if self.checkpoint is None:
+            return
+        if self.ok:
+            self.checkpoint.complete(self.start, self.stop)
+        else:
+            self.checkpoint.fail(self.start, self.stop)
@@ -0,0 +1,31 @@
+import logging
+
+class ChunkSizer(object):
+    '''Pick the length of the next bulk api time window from the size of the
+    previous response and how long the api took to send it'''
+
+    def __init__(self, target_bytes=33554432, min_period=300, max_period=2592000,
+            max_fetch_time=120, max_factor=4.0):
+        '''initialise class'''
+        self.logger         = logging.getLogger('atlas-kibana.ChunkSizer')
+        self.target_bytes   = target_bytes
+        self.min_period     = min_period
+        self.max_period     = max_period
+        self.max_fetch_time = max_fetch_time
+        self.max_factor     = max_factor
+
+    def next_period(self, period, size, fetch_time):
+        '''return the period of the next window given the period, response size in
+        bytes and fetch time in seconds of the previous one'''
+        if size > 0:
+            factor = float(self.target_bytes) / size
+        else:
+            factor = self.max_factor
+        # slow responses shrink the window even if they were small
+        if self.max_fetch_time and fetch_time > self.max_fetch_time:
+            factor = min(factor, float(self.max_fetch_time) / fetch_time)
+        factor = max(min(factor, self.max_factor), 1 / self.max_factor)
+        new_period = int(max(min(period * factor, self.max_period), self.min_period))
+        self.logger.debug('{} bytes in {:.1f}s for {}s window, next window {}s'.format(
+            size, fetch_time, period, new_period))
+        return new_period
@@ -0,0 +1,72 @@
+import os
+import bz2
+import gzip
+import json
+import itertools
+import jsonstream
+
+'''
+Read atlas results from local dump files.  Files may be plain, gzip or bz2
+compressed and hold either one json array of results or json lines with one
+result per line
+'''
+
+def find_files(paths):
+    '''return the files named by paths, directories are searched recursively'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                        if not name.startswith('.'))
+        else:
+            files.append(path)
+    return files
+
+def open_file(path):
+    '''open a dump file, detecting the compression from its first bytes'''
+    with open(path, 'rb') as dump:
+        magic = dump.read(3)
+    if magic[:2] == '\x1f\x8b':
+        return gzip.open(path, 'rb')
+    if magic == 'BZh':
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+def _iter_lines(dump):
+    '''yield the results of a json lines file'''
+    for line in dump:
+        line = line.strip()
+        if not line:
+            continue
+        yield json.loads(line)
+
+def iter_results(path):
+    '''yield the raw results of a dump file'''
+    with open_file(path) as dump:
+        chunks = jsonstream.iter_chunks(dump)
+        first  = ''
+        # look at the first character to tell an array from json lines
+        for chunk in chunks:
+            first = chunk
+            if chunk.strip():
+                break
+        chunks = itertools.chain([first], chunks)
+        if first.lstrip()[:1] == '[':
+            for result in jsonstream.iter_array(chunks):
+                yield result
+        else:
+            for result in _iter_lines(_split_lines(chunks)):
+                yield result
+
+def _split_lines(chunks):
+    '''yield the lines of an iterable of byte chunks'''
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest  = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
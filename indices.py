@@ -0,0 +1,210 @@
+import os
+import json
+import errno
+import fcntl
+import fnmatch
+import logging
+import datetime
+import threading
+import contextlib
+import elasticsearch.exceptions
+
+TEMPLATE_FILES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+        for name in ('index-dns.json', 'index-trace.json')]
+# strftime suffix of the index names for each partitioning
+PARTITIONS     = {
+        'none'    : None,
+        'daily'   : '%Y.%m.%d',
+        'monthly' : '%Y.%m',
+        }
+# index settings used while bulk loading
+BULK_SETTINGS  = {'refresh_interval': '-1', 'number_of_replicas': '0'}
+# elasticsearch defaults of the bulk load settings
+ES_DEFAULTS    = {'refresh_interval': '1s', 'number_of_replicas': '1'}
+# original settings of the indices in bulk load settings and the runs using them
+STATE_FILE     = 'bulk-settings.json'
+
+def index_name(doc_type, timestamp, partition=None):
+    '''return the index a result of doc_type at the unix timestamp goes to'''
+    if PARTITIONS.get(partition) is None:
+        return 'atlas-{}'.format(doc_type)
+    return 'atlas-{}-{}'.format(doc_type,
+            datetime.datetime.utcfromtimestamp(timestamp).strftime(PARTITIONS[partition]))
+
+def _alive(pid):
+    '''check if a process is running'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def load_template(path):
+    '''read a template file in the "PUT /_template/name" console format of
+    the bundled templates, returns (name, body)'''
+    name  = None
+    lines = []
+    with open(path) as template:
+        for line in template:
+            if line.startswith('#'):
+                continue
+            if name is None and line.strip().startswith('PUT'):
+                name = line.strip().split('/')[-1]
+                continue
+            lines.append(line)
+    if name is None:
+        raise ValueError('{}: no PUT /_template/ line'.format(path))
+    return name, json.loads(''.join(lines))
+
+
+class IndexManager(object):
+    '''Install the index templates and switch indices to bulk load settings
+    while they are written to, restoring the previous settings afterwards.
+    The index of the current period is left alone as the stream writes to it.
+    The original settings are kept in state_file with the runs on this host
+    which use them, the last run to finish restores them and a run started
+    after all of them died restores the settings they left behind'''
+
+    def __init__(self, client, bulk_settings=False, partition=None, state_file=STATE_FILE):
+        '''initialise class'''
+        self.logger        = logging.getLogger('atlas-kibana.IndexManager')
+        self.client        = client
+        self.bulk_settings = bulk_settings
+        self.partition     = partition
+        self.state_file    = state_file
+        self.lock          = threading.Lock()
+        self.prepared      = set()
+        self.defaults      = self._template_defaults(TEMPLATE_FILES)
+        if self.bulk_settings:
+            self._register()
+
+    def _template_defaults(self, files):
+        '''return (index pattern, bulk load settings) of the templates in files'''
+        defaults = []
+        for path in files:
+            try:
+                name, body = load_template(path)
+            except (IOError, ValueError) as e:
+                self.logger.warning('unable to read index template {}: {}'.format(path, e))
+                continue
+            settings = dict((key.split('.', 1)[-1] if key.startswith('index.') else key, str(value))
+                    for key, value in body.get('settings', {}).items())
+            defaults.append((body.get('template', ''), dict((key, settings[key])
+                for key in BULK_SETTINGS if key in settings)))
+        return defaults
+
+    def _default(self, index, key):
+        '''return the value a setting of an index gets from its template or elasticsearch'''
+        for pattern, settings in self.defaults:
+            if key in settings and fnmatch.fnmatchcase(index, pattern):
+                return settings[key]
+        return ES_DEFAULTS[key]
+
+    @contextlib.contextmanager
+    def _state(self):
+        '''lock and load the state file, it is saved when the block completes'''
+        with open('{}.lock'.format(self.state_file), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = dict()
+            try:
+                with open(self.state_file) as state_file:
+                    state = json.load(state_file)
+            except IOError:
+                pass
+            except ValueError as e:
+                self.logger.error('ignoring corrupt bulk settings state {}: {}'.format(self.state_file, e))
+            state.setdefault('runs', [])
+            state.setdefault('original', dict())
+            yield state
+            tmp_file = '{}.tmp'.format(self.state_file)
+            with open(tmp_file, 'w') as state_file:
+                json.dump(state, state_file, indent=1)
+            os.rename(tmp_file, self.state_file)
+
+    def _register(self):
+        '''add this run to the state, restoring the settings left by runs which died'''
+        with self._state() as state:
+            state['runs'] = [pid for pid in state['runs'] if _alive(pid)]
+            if not state['runs'] and state['original']:
+                self.logger.warning('restoring the settings of {} indices left by an interrupted run'.format(
+                    len(state['original'])))
+                self._restore_all(state)
+            state['runs'].append(os.getpid())
+
+    def _live(self, index):
+        '''check if an index is the one results of the current period go to'''
+        suffix = PARTITIONS.get(self.partition)
+        if suffix is None:
+            return True
+        return index.endswith('-' + datetime.datetime.utcnow().strftime(suffix))
+
+    def install_templates(self, files=None):
+        '''put the index templates into elasticsearch'''
+        for path in files or TEMPLATE_FILES:
+            name, body = load_template(path)
+            self.logger.info('installing index template {} from {}'.format(name, path))
+            self.client.indices.put_template(name=name, body=body)
+
+    def _prepare(self, index):
+        '''create an index and switch it to the bulk load settings'''
+        # create the index so the template applies before the settings are read
+        self.client.indices.create(index=index, ignore=400)
+        with self._state() as state:
+            # another run may already have switched the index
+            if index not in state['original']:
+                settings = self.client.indices.get_settings(index=index)
+                settings = settings[index]['settings']['index']
+                # values already in bulk load settings are not the ones to restore
+                state['original'][index] = dict((key, settings[key]) for key in BULK_SETTINGS
+                        if key in settings and str(settings[key]) != BULK_SETTINGS[key])
+            self.logger.info('{}: bulk load settings, previously {}'.format(
+                index, state['original'][index]))
+            self.client.indices.put_settings(index=index, body={'index': BULK_SETTINGS})
+
+    def prepare(self, actions):
+        '''yield actions, switching each index they write to to the bulk load settings first'''
+        for action in actions:
+            index = action.get('_index', None)
+            if self.bulk_settings and index not in self.prepared:
+                with self.lock:
+                    if index in self.prepared:
+                        pass
+                    elif self._live(index):
+                        self.logger.info('{}: written to by the stream, keeping its settings'.format(index))
+                    else:
+                        try:
+                            self._prepare(index)
+                        except elasticsearch.exceptions.TransportError as e:
+                            self.logger.warning('{}: unable to apply bulk load settings: {}'.format(index, e))
+                    self.prepared.add(index)
+            yield action
+
+    def _restore_all(self, state):
+        '''put back the original settings in the state and forget them'''
+        for index, settings in state['original'].items():
+            settings = dict(settings)
+            # settings which were not known go back to the template or elasticsearch defaults
+            for key in BULK_SETTINGS:
+                settings.setdefault(key, self._default(index, key))
+            self.logger.info('{}: restoring settings {}'.format(index, settings))
+            try:
+                self.client.indices.put_settings(index=index, body={'index': settings})
+            except elasticsearch.exceptions.TransportError as e:
+                self.logger.error('{}: unable to restore settings {}: {}'.format(index, settings, e))
+                continue
+            del state['original'][index]
+
+    def restore(self):
+        '''put back the settings the indices had before bulk loading once no
+        other run on this host uses them'''
+        if not self.bulk_settings:
+            return
+        with self.lock:
+            with self._state() as state:
+                state['runs'] = [pid for pid in state['runs'] if pid != os.getpid() and _alive(pid)]
+                if state['runs']:
+                    self.logger.info('leaving the settings of {} indices to {} running processes'.format(
+                        len(state['original']), len(state['runs'])))
+                else:
+                    self._restore_all(state)
+            self.prepared.clear()
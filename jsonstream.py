@@ -0,0 +1,121 @@
+import re
+import json
+import codecs
+import tempfile
+
+'''
+Incremental decoding of large json documents.  Only the top level array or
+object is decoded incrementally, each element is decoded with the standard
+json decoder once it has been fully read, so memory use depends on the size
+of one element rather than the whole document
+'''
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class _Reader(object):
+    '''buffer decoded text from an iterable of byte chunks'''
+
+    def __init__(self, chunks, encoding='utf-8'):
+        '''initialise class'''
+        self.chunks  = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer  = u''
+        self.index   = 0
+        self.eof     = False
+
+    def fill(self):
+        '''read the next chunk, returns False at the end of the stream'''
+        if self.eof:
+            return False
+        # drop the consumed part of the buffer
+        self.buffer = self.buffer[self.index:]
+        self.index  = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof     = True
+            self.buffer += self.decoder.decode(b'', True)
+            return True
+        self.buffer += self.decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        '''skip whitespace and return the next character or None at the end of the stream'''
+        while True:
+            self.index = _whitespace.match(self.buffer, self.index).end()
+            if self.index < len(self.buffer):
+                return self.buffer[self.index]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        '''consume the next character, which must be in chars'''
+        char = self.peek()
+        if char is None or char not in chars:
+            raise JSONStreamError('expected one of {!r} at {!r}'.format(
+                chars, self.buffer[self.index:self.index + 20]))
+        self.index += 1
+        return char
+
+    def value(self, decoder=json.JSONDecoder()):
+        '''decode the next complete json value'''
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.index)
+            except ValueError:
+                value = end = None
+            # a value ending at the end of the buffer may be truncated
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.index = end
+                return value
+            if not self.fill():
+                raise JSONStreamError('truncated json document')
+
+
+def _iter_container(reader, close, pairs):
+    '''yield the elements of an opened array or object'''
+    if reader.peek() == close:
+        reader.index += 1
+        return
+    while True:
+        if pairs:
+            key = reader.value()
+            reader.expect(':')
+            yield key, reader.value()
+        else:
+            yield reader.value()
+        if reader.expect(',' + close) == close:
+            return
+
+def iter_array(chunks):
+    '''yield the elements of a top level json array from an iterable of byte chunks'''
+    reader = _Reader(chunks)
+    reader.expect('[')
+    for value in _iter_container(reader, ']', False):
+        yield value
+
+def iter_object(chunks):
+    '''yield the (key, value) pairs of a top level json object from an iterable of byte chunks'''
+    reader = _Reader(chunks)
+    reader.expect('{')
+    for pair in _iter_container(reader, '}', True):
+        yield pair
+
+def iter_chunks(fileobj, chunk_size=65536):
+    '''yield byte chunks read from a file object'''
+    return iter(lambda: fileobj.read(chunk_size), b'')
+
+def spool_response(response, max_size=8388608, chunk_size=65536):
+    '''copy a streamed requests response into a temporary file which only
+    uses memory up to max_size, returns the file positioned at the start'''
+    response.raise_for_status()
+    spool = tempfile.SpooledTemporaryFile(max_size)
+    for chunk in response.iter_content(chunk_size):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
@@ -1,12 +1,15 @@
+import indices
 import logging
 import datetime
-import libwhois
+import resolver
 from ripe.atlas.sagan import Result, ResultParseError
 
 class Measurment(object):
     '''Parent object for atlas measurment'''
-    parsed_error = None
-    parsed       = None
+    parsed_error    = None
+    parsed          = None
+    # none, daily or monthly, see indices.PARTITIONS
+    index_partition = None
 
     def __init__(self, payload, probe):
         '''Initiate generic measurment data'''
@@ -36,11 +39,19 @@ class Measurment(object):
         '''try to force a dict from a list of objects'''
         return [ self._clean_dict(value.__dict__) for value in list_in ]
 
+    def _get_id(self):
+        '''return a document id which is stable across re-ingestion of the same result'''
+        return '{}-{}-{}'.format(self.payload.get('msm_id'), self.payload.get('prb_id'),
+                self.payload['timestamp'])
+
     def _get_source(self):
+        doc_id           = self._get_id()
         source           = self._clean_dict(self.payload)
-        source['_index'] = 'atlas-{}'.format(self.payload['type'])
+        source['_id']    = doc_id
+        source['_index'] = indices.index_name(self.payload['type'], self.payload['timestamp'],
+                self.index_partition)
         source['_type']  = 'atlas-document'
-        source['probe']  = self._clean_dict(self.probe.__dict__)
+        source['probe']  = self.probe.fragment()
         #remove the result we will replace this with something nicer
         if 'result' in source:
             del source['result']
@@ -49,8 +60,9 @@ class Measurment(object):
         return source
 
     def get_actions(self):
+        '''yield the index actions for this result'''
         self.logger.warning('no defined parser for {} so just throwing what we get from sagan'.format(self.payload['type']))
-        return [self._get_source()]
+        yield self._get_source()
         
 
 class MeasurmentDNS(Measurment):
@@ -60,9 +72,11 @@ class MeasurmentDNS(Measurment):
         self.logger = logging.getLogger('atlas-kibana.MeasurmentDNS')
 
     def get_actions(self):
-        source  = self._get_source()
-        actions = []
-        for response in self.parsed.responses:
+        '''yield one index action per dns response'''
+        base = self._get_source()
+        for index, response in enumerate(self.parsed.responses):
+            source        = dict(base)
+            source['_id'] = '{}-{}'.format(base['_id'], index)
             if response.abuf.header:
                 source['header'] = self._clean_dict(response.abuf.header.__dict__)
             if response.abuf.edns0:
@@ -77,17 +91,39 @@ class MeasurmentDNS(Measurment):
             if response.abuf.additionals:
                 source['additionals'] = self._clean_array(response.abuf.additionals)
             self.logger.debug('Yeild measuerment {}'.format(source))
-            actions.append(source)
-        return actions
+            yield source
 
 class MeasurmentTraceroute(Measurment):
 
+    asn_resolver = resolver.ASNResolver()
+
     def __init__(self, payload, probe):
         super(MeasurmentTraceroute, self).__init__(payload, probe)
         self.logger    = logging.getLogger('atlas-kibana.MeasurmentTraceroute')
-        self.asn_whois = libwhois.ASNWhois()
+
+    @staticmethod
+    def get_origins(payload):
+        '''return the first responding address of each hop from a raw result'''
+        origins = set()
+        for hop in payload.get('result', None) or []:
+            for packet in hop.get('result', None) or []:
+                if 'from' in packet:
+                    origins.add(packet['from'])
+                    break
+        return origins
+
+    @classmethod
+    def prefetch(cls, payloads):
+        '''resolve the hop origins of many raw results with one bulk query'''
+        origins = set()
+        for payload in payloads:
+            if payload.get('type', None) == 'traceroute':
+                origins.update(cls.get_origins(payload))
+        if origins:
+            cls.asn_resolver.prefetch(origins)
 
     def get_actions(self):
+        '''yield the index action for this traceroute'''
         source                             = self._get_source()
         source['hops']                     = self._clean_array(self.parsed.hops)
         source['destination_ip_responded'] = self.parsed.destination_ip_responded
@@ -95,22 +131,28 @@ class MeasurmentTraceroute(Measurment):
         source['last_rtt']                 = self.parsed.last_rtt
         source['total_hops']               = self.parsed.total_hops
         seen_as                            = set()
-        self.asn_whois.query               = []
+        origins                            = []
         for hop in source['hops']:
             hop['packets']       = self._clean_array(hop['packets'])
             hop['first_origin']  = hop['packets'][0].get('origin', None)
             if hop['first_origin']:
-                self.asn_whois.query.append(hop['first_origin'])
+                origins.append(hop['first_origin'])
         #loop twice to so we only make one call to shadow servers
+        asns = self.asn_resolver.resolve(origins)
         for hop in source['hops']:
             try:
-                hop['asn'] = self.asn_whois.result[hop['first_origin']].asn
+                hop['asn'] = asns[hop['first_origin']].asn
                 seen_as.add(hop['asn'])
             except KeyError:
                 self.logger.debug('unable to get first_origin for {} {}'.format(self.parsed, hop['first_origin']))
-            except libwhois.QueryError:
-                self.logger.warning('unable to get ASN for {} {}'.format(self.parsed, hop['first_origin']))
         source['total_as_hops'] = len(seen_as)
-        return [source]
+        yield source
+
 
 
+def get_measurement(payload, probe):
+    '''return the Measurment object for a raw result'''
+    return {
+            'dns': MeasurmentDNS,
+            'traceroute': MeasurmentTraceroute,
+            }.get(payload['type'], Measurment)(payload, probe)
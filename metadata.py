@@ -0,0 +1,110 @@
+import Queue
+import logging
+import threading
+from ripe.atlas.cousteau import MeasurementRequest
+
+# fields which change while a measurement is running
+MUTABLE_FIELDS = ['status', 'stop_time', 'participant_count', 'probes_scheduled', 'is_public']
+# status ids of measurements which will not change any more
+FINAL_STATUS   = [4, 5, 6, 7, 8]
+
+class MeasurementMetadata(object):
+    '''Load the metadata of measurements on a pool of threads.  Metadata is
+    kept in the on disk cache, for measurements which are still running only
+    the mutable fields are fetched again.  Iterating gives the measurement
+    ids straight away, looking up a measurement waits until its metadata has
+    been loaded and raises KeyError if it could not be'''
+
+    def __init__(self, cache, threads=8, ttl=2592000):
+        '''initialise class'''
+        self.logger   = logging.getLogger('atlas-kibana.MeasurementMetadata')
+        self.cache    = cache
+        self.threads  = threads
+        self.ttl      = ttl
+        self.queue    = Queue.Queue()
+        self.ids      = []
+        self.metadata = dict()
+        self.loaded   = dict()
+
+    @staticmethod
+    def _request(measurement_id, **filters):
+        '''fetch a measurement from the atlas api'''
+        filters['msm_id'] = measurement_id
+        return MeasurementRequest(**filters).next()
+
+    @staticmethod
+    def _final(meta):
+        '''check if a measurement has finished and its metadata will not change'''
+        status = meta.get('status', None)
+        if isinstance(status, dict):
+            status = status.get('id', None)
+        return status in FINAL_STATUS
+
+    def _fetch(self, measurement_id):
+        '''return the metadata of a measurement from the cache or the api'''
+        try:
+            meta = self.cache.get('measurement', measurement_id)
+        except KeyError:
+            self.logger.info('fetch msm metata data: {}'.format(measurement_id))
+            meta = self._request(measurement_id)
+        else:
+            if self._final(meta):
+                return meta
+            self.logger.info('refresh msm metata data: {}'.format(measurement_id))
+            fresh = self._request(measurement_id, fields=','.join(MUTABLE_FIELDS))
+            for field in MUTABLE_FIELDS:
+                if field in fresh:
+                    meta[field] = fresh[field]
+        self.cache.set('measurement', measurement_id, meta, self.ttl)
+        return meta
+
+    def _worker(self):
+        '''load metadata for measurement ids from the queue'''
+        while True:
+            measurement_id = self.queue.get()
+            try:
+                self.metadata[measurement_id] = self._fetch(measurement_id)
+                self.logger.debug('fetched msm metata data: {}\n{}'.format(
+                    measurement_id, self.metadata[measurement_id]))
+            except Exception as e:
+                self.logger.error('{}: unable to fetch measurement metadata: {}'.format(measurement_id, e))
+            finally:
+                self.loaded[measurement_id].set()
+
+    def load(self, measurement_ids):
+        '''start loading the metadata of measurement ids in the background'''
+        for measurement_id in measurement_ids:
+            if measurement_id in self.loaded:
+                continue
+            self.ids.append(measurement_id)
+            self.loaded[measurement_id] = threading.Event()
+            self.queue.put(measurement_id)
+        for i in range(min(self.threads, len(self.ids))):
+            thread        = threading.Thread(target=self._worker, name='metadata-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def __getitem__(self, measurement_id):
+        '''wait for and return the metadata of a measurement'''
+        loaded = self.loaded[measurement_id]
+        # wait with a timeout so KeyboardInterrupt is still delivered
+        while not loaded.wait(1):
+            pass
+        return self.metadata[measurement_id]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, measurement_id):
+        return measurement_id in self.loaded
+
+    def items(self):
+        '''yield (measurement id, metadata) in order, skipping measurements which failed to load'''
+        for measurement_id in self.ids:
+            try:
+                yield measurement_id, self[measurement_id]
+            except KeyError:
+                pass
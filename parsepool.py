@@ -0,0 +1,106 @@
+import probe
+import logging
+import itertools
+import traceback
+import collections
+import measuerments
+import multiprocessing
+
+# the probe store opened by each worker process
+_probes_file = None
+_probe_store = None
+_probe_cache = dict()
+
+def batches(iterable, size):
+    '''yield lists of up to size items from iterable'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def parse_results(results, get_probe, counts=None):
+    '''convert raw atlas results into index actions.
+    returns (actions, errors, missing) where errors is a list of
+    (msm_id, prb_id, timestamp, message) and missing the set of unknown probe ids.
+    the number of results is appended to counts if it is given'''
+    if counts is not None:
+        counts.append(len(results))
+    actions = []
+    errors  = []
+    missing = set()
+    measuerments.MeasurmentTraceroute.prefetch(results)
+    for result in results:
+        probe_id  = result.get('prb_id', None)
+        msm_id    = result.get('msm_id', None)
+        timestamp = result.get('timestamp', None)
+        try:
+            result_probe = get_probe(probe_id)
+            if not result_probe:
+                missing.add(probe_id)
+                continue
+            actions += measuerments.get_measurement(result, result_probe).get_actions()
+        except Exception as e:
+            errors.append((msm_id, probe_id, timestamp, '{}: {}\n{}'.format(
+                e.__class__.__name__, e, traceback.format_exc())))
+    return actions, errors, missing
+
+def _init_worker(probes_file):
+    '''set up a worker process, the probe store is opened on first use'''
+    global _probes_file, _probe_store
+    _probes_file = probes_file
+    _probe_store = None
+    _probe_cache.clear()
+
+def _get_probe(probe_id):
+    '''get a probe from the worker probe store'''
+    probe_id = int(probe_id)
+    try:
+        return _probe_cache[probe_id]
+    except KeyError:
+        pass
+    global _probe_store
+    if _probe_store is None:
+        _probe_store = probe.ProbeStore(_probes_file)
+    raw = _probe_store.get_raw(probe_id)
+    if raw is None:
+        return False
+    return _probe_cache.setdefault(probe_id, probe.Probe.from_json(raw))
+
+def _parse_batch(results):
+    '''parse a batch of results in a worker process'''
+    return parse_results(results, _get_probe)
+
+
+class ParsePool(object):
+    '''Parse raw results in a pool of worker processes.  Each worker reads
+    probes from the saved probe store, opened when the first batch is parsed,
+    so probes must be saved before then.  Create the pool before starting any
+    thread, forking a process with running threads can deadlock it'''
+
+    def __init__(self, probes_file, workers=None):
+        '''initialise class'''
+        self.logger  = logging.getLogger('atlas-kibana.ParsePool')
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool    = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                initargs=(probes_file,))
+
+    def imap(self, batches, counts=None):
+        '''parse batches of results in the worker processes, yields the
+        parse_results() tuple of each batch in order.  At most two batches per
+        worker are in flight so batches are only read as fast as they are parsed'''
+        pending = collections.deque()
+        for batch in batches:
+            if counts is not None:
+                counts.append(len(batch))
+            pending.append(self.pool.apply_async(_parse_batch, (batch,)))
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        '''stop the worker processes'''
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,79 @@
+import Queue
+import logging
+import threading
+
+class Stage(object):
+    '''A pipeline stage, func is called for each input item and returns an
+    iterable of output items for the next stage'''
+
+    def __init__(self, name, func, workers=1):
+        '''initialise class'''
+        self.name    = name
+        self.func    = func
+        self.workers = max(int(workers), 1)
+
+
+class Pipeline(object):
+    '''Run items through a list of stages.  Each stage has its own worker
+    threads and stages are connected with bounded queues, so a slow stage
+    blocks the stages in front of it instead of buffering without limit'''
+
+    _stop = object()
+
+    def __init__(self, stages, queue_size=4):
+        '''initialise class'''
+        self.logger     = logging.getLogger('atlas-kibana.Pipeline')
+        self.stages     = stages
+        self.queue_size = queue_size
+        self.errors     = 0
+
+    def _worker(self, stage, inbox, outbox, remaining, lock):
+        '''process items from inbox until the stop marker is seen'''
+        while True:
+            item = inbox.get()
+            if item is self._stop:
+                break
+            try:
+                for result in stage.func(item) or []:
+                    if outbox is not None:
+                        outbox.put(result)
+            except Exception as e:
+                self.logger.exception('{}: failed to process item: {}'.format(stage.name, e))
+                with lock:
+                    self.errors += 1
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        # the last worker of a stage tells the next stage there is nothing more coming
+        if last and outbox is not None:
+            for i in range(self.next_workers[id(stage)]):
+                outbox.put(self._stop)
+
+    def run(self, items):
+        '''feed items to the first stage and wait for all stages to finish,
+        returns the number of items which raised an exception'''
+        queues = [Queue.Queue(self.queue_size) for stage in self.stages]
+        lock   = threading.Lock()
+        self.next_workers = dict()
+        for index, stage in enumerate(self.stages[:-1]):
+            self.next_workers[id(stage)] = self.stages[index + 1].workers
+        threads = []
+        for index, stage in enumerate(self.stages):
+            outbox    = queues[index + 1] if index + 1 < len(queues) else None
+            remaining = [stage.workers]
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._worker,
+                        name='{}-{}'.format(stage.name, i),
+                        args=(stage, queues[index], outbox, remaining, lock))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            queues[0].put(item)
+        for i in range(self.stages[0].workers):
+            queues[0].put(self._stop)
+        for thread in threads:
+            # join with a timeout so KeyboardInterrupt is still delivered
+            while thread.is_alive():
+                thread.join(1)
+        return self.errors
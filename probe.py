@@ -1,68 +1,340 @@
+import os
+import mmap
+import json
+import time
 import Queue
+import cache
 import pickle
+import struct
 import netaddr
 import logging
 import requests
 import ripestat
+import rirtable
 import threading
+import collections
+
+class ProbeStore(object):
+    '''Read only, memory mapped probe store.
+
+    The file holds a header, a table of fixed size (offset, length) records
+    indexed directly by probe id and the json encoded probes.  Probes are only
+    decoded when they are asked for'''
+    magic  = 'AKP1'
+    header = struct.Struct('<4sII')
+    record = struct.Struct('<II')
+
+    def __init__(self, store_file=None):
+        '''initialise class'''
+        self.logger     = logging.getLogger('atlas-kibana.ProbeStore')
+        self.store_file = store_file
+        self.data       = None
+        self.slots      = 0
+        self.count      = 0
+        if store_file and os.path.exists(store_file):
+            self._open()
+
+    def _open(self):
+        '''memory map the store file'''
+        with open(self.store_file, 'rb') as store:
+            self.data = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.count = self.header.unpack_from(self.data, 0)
+        if magic != self.magic:
+            self.close()
+            raise ValueError('{} is not a probe store'.format(self.store_file))
+
+    def __len__(self):
+        '''number of stored probes'''
+        return self.count
+
+    def __contains__(self, probe_id):
+        '''check if the probe is in the store'''
+        return self._locate(probe_id)[1] > 0
+
+    def _locate(self, probe_id):
+        '''return the (offset, length) of a probe, length is 0 if its missing'''
+        if self.data is None or not 0 <= probe_id < self.slots:
+            return 0, 0
+        return self.record.unpack_from(self.data,
+                self.header.size + probe_id * self.record.size)
+
+    def ids(self):
+        '''iterate over the stored probe ids'''
+        for probe_id in xrange(self.slots):
+            if probe_id in self:
+                yield probe_id
+
+    def get_raw(self, probe_id):
+        '''return the encoded probe or None'''
+        offset, length = self._locate(probe_id)
+        if not length:
+            return None
+        return self.data[offset:offset + length]
+
+    def get(self, probe_id):
+        '''return the decoded probe dict or None'''
+        raw = self.get_raw(probe_id)
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    def close(self):
+        '''unmap the store file'''
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    @classmethod
+    def write(cls, store_file, records):
+        '''write a dict of probe id -> encoded probe to store_file'''
+        slots    = max(records) + 1 if records else 0
+        tmp_file = '{}.tmp'.format(store_file)
+        offset   = cls.header.size + slots * cls.record.size
+        table    = []
+        for probe_id in xrange(slots):
+            length = len(records.get(probe_id, ''))
+            table.append(cls.record.pack(offset if length else 0, length))
+            offset += length
+        with open(tmp_file, 'wb') as store:
+            store.write(cls.header.pack(cls.magic, slots, len(records)))
+            store.write(''.join(table))
+            for probe_id in sorted(records):
+                store.write(records[probe_id])
+        os.rename(tmp_file, store_file)
+
+    @staticmethod
+    def encode(probe):
+        '''encode a probe for the store'''
+        return probe.fragment_json()
+
 
 class Probes(object):
     '''return a class with all atlas probes'''
     probe_api_url     = 'https://atlas.ripe.net/api/v1/probe/'
     probe_archive_url = 'https://atlas.ripe.net/api/v1/probe-archive/?format=json'
 
-    def __init__(self, refresh=False, probes_file='probes.p', threads=200):
+    def __init__(self, refresh=False, probes_file='probes.db', threads=200,
+            cache_file='enrich-cache.db', cache_ttl=604800, legacy_file='probes.p',
+            rir_files=None, lru_size=None):
         '''initialise class'''
         self.probes_file = probes_file
+        self.legacy_file = legacy_file
+        Probe.enrich_cache = cache.Cache(cache_file, ttl=cache_ttl,
+                ttls={'restcountries': cache_ttl * 4})
+        if rir_files:
+            Probe.rir_table = rirtable.RIRTable(rir_files)
         self.logger      = logging.getLogger('atlas-kibana.Probes')
         self.threads     = threads
         self.queue       = Queue.Queue(self.threads * 2)
-        self.probes      = set()
+        self.lock        = threading.Lock()
+        self.store       = ProbeStore()
+        # probes changed since the last save, stored probes are decoded into
+        # a bounded LRU, by default large enough for every stored probe
+        self.probes      = dict()
+        self.lru         = collections.OrderedDict()
+        self.lru_size    = lru_size
+        self.lru_lock    = threading.Lock()
+        self.dirty       = False
+        self.indexed     = False
+        self.workers     = []
+        self.stats       = collections.Counter()
+        self.by_asn      = dict()
+        self.by_country  = dict()
+        self.by_prefix   = dict()
         self.load()
         if refresh:
             self.refresh()
         self.save()
+        Probe.enrich_cache.purge()
     
+    def __len__(self):
+        '''number of probes in the registry'''
+        return len(self.ids())
+
+    def __iter__(self):
+        '''iterate over the probes in the registry'''
+        for probe_id in sorted(self.ids()):
+            yield self.get(probe_id)
+
+    def ids(self):
+        '''return the set of known probe ids'''
+        return set(self.probes).union(self.store.ids())
+
     def exists(self, probe_id):
         '''check if we already have this probe'''
-        for probe in self.probes.copy():
-            if probe.id == int(probe_id):
-                return True
-        return False
+        probe_id = int(probe_id)
+        return probe_id in self.probes or probe_id in self.store
 
     def get(self, probe_id):
         '''get an probe element'''
-        for probe in self.probes.copy():
-            if probe.id == int(probe_id):
+        probe_id = int(probe_id)
+        try:
+            return self.probes[probe_id]
+        except KeyError:
+            pass
+        with self.lru_lock:
+            try:
+                probe = self.lru.pop(probe_id)
+                self.lru[probe_id] = probe
                 return probe
-        return False
+            except KeyError:
+                pass
+        raw = self.store.get_raw(probe_id)
+        if raw is None:
+            return False
+        probe = Probe.from_json(raw)
+        self._lru_set(probe)
+        return probe
+
+    def _lru_set(self, probe):
+        '''add a probe to the LRU of decoded probes'''
+        with self.lru_lock:
+            self.lru.pop(probe.id, None)
+            self.lru[probe.id] = probe
+            while len(self.lru) > (self.lru_size or max(len(self.store), 1)):
+                self.lru.popitem(last=False)
+
+    def get_by_asn(self, asn):
+        '''get all probes announced by an asn (v4 or v6)'''
+        return self._get_indexed(self.by_asn, int(asn))
+
+    def get_by_country(self, country_code):
+        '''get all probes in a country'''
+        return self._get_indexed(self.by_country, country_code.upper())
+
+    def get_by_prefix(self, prefix):
+        '''get all probes in a prefix (v4 or v6)'''
+        return self._get_indexed(self.by_prefix, prefix)
+
+    def _get_indexed(self, index, key):
+        '''resolve a secondary index entry to probe objects'''
+        if not self.indexed:
+            self._build_indexes()
+        return [self.get(probe_id) for probe_id in index.get(key, ())]
+
+    def _build_indexes(self):
+        '''build the secondary indexes, this decodes every stored probe'''
+        self.logger.info('building probe indexes')
+        for probe in self:
+            with self.lock:
+                self._index(probe)
+        self.indexed = True
+
+    @staticmethod
+    def _index_keys(probe):
+        '''return the (index name, key) pairs a probe should be listed under'''
+        keys = []
+        for asn in set([probe.asn_v4, probe.asn_v6]):
+            if asn:
+                keys.append(('by_asn', int(asn)))
+        if probe.country_code:
+            keys.append(('by_country', probe.country_code.upper()))
+        for prefix in set([probe.prefix_v4, probe.prefix_v6]):
+            if prefix:
+                keys.append(('by_prefix', prefix))
+        return keys
+
+    def _index(self, probe):
+        '''add a probe to the secondary indexes, caller must hold the lock'''
+        for index, key in self._index_keys(probe):
+            getattr(self, index).setdefault(key, set()).add(probe.id)
+
+    def _unindex(self, probe):
+        '''remove a probe from the secondary indexes, caller must hold the lock'''
+        for index, key in self._index_keys(probe):
+            ids = getattr(self, index).get(key, set())
+            ids.discard(probe.id)
+            if not ids:
+                getattr(self, index).pop(key, None)
+
+    def add(self, probe):
+        '''add or replace a probe in the registry and secondary indexes'''
+        with self.lock:
+            if self.indexed:
+                old = self.get(probe.id)
+                if old:
+                    self._unindex(old)
+                self._index(probe)
+            self.probes[probe.id] = probe
+            with self.lru_lock:
+                self.lru.pop(probe.id, None)
+            self.dirty = True
 
     def load(self):
-        '''load pickle data'''
+        '''open the probe store, falling back to the legacy pickle file'''
+        try:
+            self.logger.info('Loading probes from {}'.format(self.probes_file))
+            self.store = ProbeStore(self.probes_file)
+        except (IOError, ValueError, mmap.error, struct.error) as e:
+            self.logger.warning('unable to load probes file {}: {}'.format(self.probes_file, e))
+        if len(self.store) or not self.legacy_file:
+            self.logger.info('Finished loading {} probes'.format(len(self.store)))
+            return
         try:
             self.logger.info('Loading probes from pickle file')
-            self.probes = pickle.load(open(self.probes_file, 'rb'))
+            probes = pickle.load(open(self.legacy_file, 'rb'))
+            # older pickle files store a set of probes
+            if isinstance(probes, dict):
+                probes = probes.values()
+            for probe in probes:
+                self.add(probe)
             self.logger.info('Finished loading probes')
         except IOError:
-            self.logger.warning('unable to load probes file {}'.format(self.probes_file))
+            self.logger.warning('unable to load probes file {}'.format(self.legacy_file))
+
+    def _refresh_probe(self, record, force=False):
+        '''add or update a probe from a probe archive record, only probes whose
+        enrichment inputs changed are re-enriched'''
+        # compare against the stored dict, a probe is only built when it changed
+        current = self.probes.get(int(record['id']), None)
+        if current is not None:
+            current = current.to_dict()
+        else:
+            current = self.store.get(int(record['id']))
+        if current is None:
+            self.add(Probe(record))
+            return 'added'
+        if force:
+            self.add(Probe(record))
+            return 'enriched'
+        changed = Probe.diff(current, record)
+        if not changed:
+            return 'unchanged'
+        self.logger.debug('{}:changed {}'.format(record['id'], ', '.join(changed)))
+        if Probe.enrichment_fields.intersection(changed):
+            self.add(Probe(record))
+            return 'enriched'
+        probe = Probe.from_dict(current)
+        probe.set_fields(record)
+        self.add(probe)
+        return 'updated'
 
-    def load_probe(self, force=False):
+    def load_probe(self):
         '''load a probe from the queue'''
         while True:
-            probe = self.queue.get()
+            probe, force = self.queue.get()
             try:
-                if not self.exists(probe['id']):
-                    self.probes.add(Probe(probe))
-                    self.logger.info('{}:Added'.format(probe['id']))
-                else:
-                    self.logger.debug('{}:Already Exists'.format(probe['id']))
+                result = self._refresh_probe(probe, force)
+                self.logger.debug('{}:{}'.format(probe['id'], result))
+                with self.lock:
+                    self.stats[result] += 1
             except Exception as e: 
                 # This will likly come back and bite me :S
                 self.logger.warning('{}:could not process\n{}'.format(probe['id'], e))
             self.queue.task_done()
 
+    def _start_workers(self):
+        '''start the load_probe worker threads once'''
+        if self.workers:
+            return
+        for i in range(self.threads):
+            thread        = threading.Thread(target=self.load_probe)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
     def refresh(self, force=False):
-        '''load all atlas probes'''
+        '''load all atlas probes, only changed probes are updated unless force is set'''
         try:
             self.logger.info('fetching {}'.format(self.probe_archive_url))
             probes = requests.get(self.probe_archive_url, verify=False).json().get(
@@ -71,46 +343,79 @@ class Probes(object):
         except Exception as e:
             self.logger.error('Could not fetch {0}:\n{1}'.format(self.probe_archive_url, e))
             return False
-        for i in range(self.threads):
-            thread        = threading.Thread(target=self.load_probe)
-            thread.daemon = True
-            thread.start()
-        if force:
-            self.logger.info('Clering all probes')
-            self.probes.clear()
+        self._start_workers()
+        self.stats = collections.Counter()
         for probe in probes:
-            self.queue.put(probe)
+            self.queue.put((probe, force))
         self.queue.join()
+        self.logger.info('refreshed probes: {}'.format(dict(self.stats)))
         return True
 
+    def _refresh_loop(self, interval):
+        '''periodically refresh and save the probes'''
+        while True:
+            time.sleep(interval)
+            try:
+                if self.refresh():
+                    self.save()
+            except Exception as e:
+                self.logger.error('scheduled probe refresh failed:\n{}'.format(e))
+
+    def start_refresh(self, interval):
+        '''refresh the probes every interval seconds in a background thread'''
+        self.logger.info('refreshing probes every {} seconds'.format(interval))
+        thread        = threading.Thread(target=self._refresh_loop, args=(interval,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def save(self):
-        '''save the probes data'''
-        pickle.dump(self.probes, open(self.probes_file, 'wb'))
+        '''save the probes data if it has changed'''
+        if not self.dirty:
+            self.logger.debug('probes unchanged, not saving')
+            return
+        self.logger.info('saving probes to {}'.format(self.probes_file))
+        with self.lock:
+            records = dict((probe_id, self.store.get_raw(probe_id))
+                    for probe_id in self.store.ids())
+            for probe_id, probe in self.probes.items():
+                records[probe_id] = ProbeStore.encode(probe)
+            ProbeStore.write(self.probes_file, records)
+            # the old map is released once concurrent readers are done with it
+            self.store = ProbeStore(self.probes_file)
+            # saved probes are read from the store again, keep the decoded ones
+            # in the LRU rather than holding on to every one
+            for probe_id, probe in self.probes.items():
+                self._lru_set(probe)
+                del self.probes[probe_id]
+            self.dirty = False
+
+class Fragment(dict):
+    '''The probe sub document of measurement documents, json holds its encoding'''
+    json = None
+
 
 class Probe(object):
 
+    fields       = ('status', 'status_since', 'address_v4', 'address_v6', 'asn_v4', 'asn_v6',
+            'country_code', 'latitude', 'longitude', 'prefix_v4', 'prefix_v6', 'id', 'is_anchor',
+            'is_public', 'resource_uri', 'tooltip', 'geojson', 'tags', 'location',
+            'asn_v4_name', 'asn_v6_name', 'prefixlen_v4', 'rir_v4', 'prefixlen_v6', 'rir_v6')
+    # the document fragment is built once and shared by every result of the probe
+    __slots__    = fields + ('_fragment', '_fragment_json')
+    logger       = logging.getLogger('atlas-kibana.Probe')
+    stat_api     = ripestat.StatAPI('Atlas-Kibana')
+    enrich_cache = cache.Cache(None)
+    rir_table    = None
+    # fields which are copied from the probe archive
+    archive_fields    = ('status', 'status_since', 'address_v4', 'address_v6', 'asn_v4',
+            'asn_v6', 'country_code', 'latitude', 'longitude', 'prefix_v4', 'prefix_v6', 'id',
+            'is_anchor', 'is_public', 'resource_uri', 'tooltip', 'geojson', 'tags')
+    # archive fields which update() uses to fetch metadata
+    enrichment_fields = frozenset(['country_code', 'asn_v4', 'asn_v6', 'prefix_v4', 'prefix_v6'])
+
     def __init__(self, probe):
-        self.logger       = logging.getLogger('atlas-kibana.Probe')
-        self.status       = probe.get('status_name',  None)
-        self.status_since = probe.get('status_since', None)
-        self.address_v4   = probe.get('address_v4',   None)
-        self.address_v6   = probe.get('address_v6',   None)
-        self.asn_v4       = probe.get('asn_v4',       None)
-        self.asn_v6       = probe.get('asn_v6',       None)
-        self.country_code = probe.get('country_code', None)
-        self.latitude     = probe.get('latitude',     None)
-        self.longitude    = probe.get('longitude',    None)
-        self.prefix_v4    = probe.get('prefix_v4',    None)
-        self.prefix_v6    = probe.get('prefix_v6',    None)
-        self.id           = probe.get('id',           None)
-        self.is_anchor    = probe.get('is_anchor',    None)
-        self.is_public    = probe.get('is_public',    None)
-        self.resource_uri = probe.get('resource_uri', None)
-        self.tooltip      = 'Probe #{0}: https://atlas.ripe.net/probes/{0}/'.format(self.id)
-        self.geojson      = [self.longitude, self.latitude]
-        self.stat_api     = ripestat.StatAPI('Atlas-Kibana')
-        self.tags         = []
-        self.tags.extend(probe.get('tags', None))
+        self.set_fields(probe)
         self.location     = dict()
         self.asn_v4_name  = None
         self.asn_v6_name  = None
@@ -121,19 +426,91 @@ class Probe(object):
 
         self.update()
 
+    @staticmethod
+    def archive_values(probe):
+        '''return the archive fields of a probe archive record as a dict'''
+        values = dict()
+        values['status']       = probe.get('status_name',  None)
+        values['status_since'] = probe.get('status_since', None)
+        values['address_v4']   = probe.get('address_v4',   None)
+        values['address_v6']   = probe.get('address_v6',   None)
+        values['asn_v4']       = probe.get('asn_v4',       None)
+        values['asn_v6']       = probe.get('asn_v6',       None)
+        values['country_code'] = probe.get('country_code', None)
+        values['latitude']     = probe.get('latitude',     None)
+        values['longitude']    = probe.get('longitude',    None)
+        values['prefix_v4']    = probe.get('prefix_v4',    None)
+        values['prefix_v6']    = probe.get('prefix_v6',    None)
+        values['id']           = probe.get('id',           None)
+        values['is_anchor']    = probe.get('is_anchor',    None)
+        values['is_public']    = probe.get('is_public',    None)
+        values['resource_uri'] = probe.get('resource_uri', None)
+        values['tooltip']      = 'Probe #{0}: https://atlas.ripe.net/probes/{0}/'.format(values['id'])
+        values['geojson']      = [values['longitude'], values['latitude']]
+        values['tags']         = list(probe.get('tags', None) or [])
+        return values
+
+    def set_fields(self, probe):
+        '''set the fields copied from a probe archive record'''
+        for field, value in self.archive_values(probe).iteritems():
+            setattr(self, field, value)
+        self._reset_fragment()
+
+    @classmethod
+    def diff(cls, current, probe):
+        '''return the archive fields of a to_dict() which differ from a probe archive record'''
+        values = cls.archive_values(probe)
+        return [field for field in cls.archive_fields
+                if current.get(field, None) != values[field]]
+
+    @classmethod
+    def from_dict(cls, d):
+        '''create a probe from a to_dict() without refreshing the metadata'''
+        probe = cls.__new__(cls)
+        probe.__setstate__(d)
+        return probe
+
+    @classmethod
+    def from_json(cls, raw):
+        '''create a probe from an encoded to_dict(), keeping the encoding as
+        the serialised document fragment'''
+        probe = cls.from_dict(json.loads(raw))
+        probe._fragment_json = raw
+        return probe
+
+    def to_dict(self):
+        '''return the probe data as a dict'''
+        return dict((field, getattr(self, field, None)) for field in self.fields)
+
+    def _reset_fragment(self):
+        '''drop the document fragment after the fields change'''
+        self._fragment      = None
+        self._fragment_json = None
+
+    def fragment(self):
+        '''return the probe sub document of measurement documents.  the dict
+        is shared by all documents of the probe and must not be modified'''
+        if self._fragment is None:
+            fragment = Fragment(self.to_dict())
+            if self._fragment_json is None:
+                self._fragment_json = json.dumps(fragment, separators=(',', ':'))
+            fragment.json  = self._fragment_json
+            self._fragment = fragment
+        return self._fragment
+
+    def fragment_json(self):
+        '''return the probe sub document serialised as compact json'''
+        return self.fragment().json
+
     def __getstate__(self):
-        '''remove logger and api from logger'''
-        d = dict(self.__dict__)
-        del d['logger']
-        del d['stat_api']
-        return d
+        '''pickle the slots'''
+        return self.to_dict()
 
     def __setstate__(self, d):
-        '''recreate logger and stat_api'''
-        d['stat_api'] = ripestat.StatAPI('Atlas-Kibana')
-        d['logger']   = logging.getLogger('atlas-kibana.Probe')
-        self.__dict__.update(d)
-
+        '''restore the slots, this also accepts pickles of the old dict based probe'''
+        for field in self.fields:
+            setattr(self, field, d.get(field, None))
+        self._reset_fragment()
 
     def __eq__(self, other):
         '''Check equality'''
@@ -159,11 +536,12 @@ class Probe(object):
         '''use restcountries.eu to get the location'''
         url = 'http://restcountries.eu/rest/v1/alpha/{}'.format(country_code.lower())
         try:
-            location = requests.get(url, verify=False).json()
+            location = self.enrich_cache.fetch('restcountries', country_code.lower(),
+                    lambda: requests.get(url, verify=False).json())
             self.logger.debug('{}:Add location for {}'.format(self.id, country_code))
             return location
         except Exception as e:
-            self.logger.error('Could not fetch {}:{}\n{}'.format(url, location,  e))
+            self.logger.error('Could not fetch {}:\n{}'.format(url, e))
 
     def get_location(self):
         location          = self.get_location_meta(self.country_code)
@@ -188,11 +566,19 @@ class Probe(object):
         if self.prefix_v6:
             self.prefixlen_v6 = self.get_prefix_len(self.prefix_v6)
             self.rir_v6       = self.get_rir(self.prefix_v6)
+        self._reset_fragment()
 
     def get_rir(self, prefix):
-        '''use RIPEstat to get the rir name'''
+        '''use the delegated stats table or RIPEstat to get the rir name'''
+        if self.rir_table is not None:
+            rir = self.rir_table.lookup(prefix)
+            if rir:
+                self.logger.debug('{}:Add RIR "{}" for {}'.format(self.id, rir, prefix))
+                return rir
         try:
-            whois = self.stat_api.get_data('whois', {'resource': prefix})
+            whois = self.enrich_cache.fetch('whois', prefix, lambda: {
+                'authorities': self.stat_api.get_data('whois',
+                    {'resource': prefix}).get('authorities', [])})
             self.logger.debug('recived ripe stat info:\n{}'.format(whois))
             rir   = u','.join(whois.get('authorities', [])).encode('utf-8')
             self.logger.debug('{}:Add RIR "{}" for {}'.format(self.id, rir, prefix))
@@ -203,8 +589,9 @@ class Probe(object):
     def get_asn_name(self, asn):
         '''use RIPEstat to get the asn name'''
         try:
-            asn_name = self.stat_api.get_data('as-overview',
-                {'resource': asn}).get('holder', None).encode('utf-8')
+            asn_name = self.enrich_cache.fetch('as-overview', asn, lambda: {
+                'holder': self.stat_api.get_data('as-overview',
+                    {'resource': asn}).get('holder', None)}).get('holder').encode('utf-8')
             self.logger.debug('{}:Add AS name "{}" for {}'.format(
                 self.id, asn_name, asn))
             return asn_name
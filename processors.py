@@ -1,21 +1,55 @@
 import pdb
+import os
 import sys
 import json
+import zlib
 import time
+import random
+import Queue
 import probe
+import indices
+import metadata
+import archive
+import pipeline
+import bulkbody
+import bulkretry
+import parsepool
 import logging
 import requests
 import argparse
+import threading
+import collections
+import checkpoint
+import chunksizer
+import resolver
+import streamsink
+import streamclient
+import itertools
+import multiprocessing.pool
+import dumpfile
+import jsonstream
+import routetable
 import measuerments
-import socketIO_client
 import elasticsearch
-import elasticsearch.helpers
 import elasticsearch.exceptions
-from ripe.atlas.cousteau import MeasurementRequest
 
 ATLAS_LATEST_API = 'https://atlas.ripe.net/api/v1/measurement-latest/{}/'
 ATLAS_BULK_API   = 'https://atlas.ripe.net/api/v1/measurement/{}/result/?start={}&stop={}'
 ATLAS_STREAM_API = 'http://atlas-stream.ripe.net/stream/socket.io'
+ARCHIVE_DIR      = 'archive'
+PROBES_FILE      = 'probes.db'
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+MAX_BACKOFF      = 60
+
+def shard(value):
+    '''argparse type for --shard, converts i/N into a zero based (index, count)'''
+    try:
+        index, count = [int(token) for token in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be i/N, got {}'.format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard {} is not between 1 and {}'.format(index, count))
+    return index - 1, count
 
 class Processor(object):
 
@@ -24,27 +58,71 @@ class Processor(object):
     actions         = []
     already_warned  = []
     measurement_ids = dict()
+    bulk_load       = False
+    # processors which parse results with _parse_batches, only they use --parse-processes
+    parses          = False
 
     def __init__(self, args):
         self.logger           = logging.getLogger('atlas-kibana.Processor')
-        self.probes           = probe.Probes(args.refresh_probes)
+        # the parse workers inherit the class configuration, set it first
+        measuerments.Measurment.index_partition = args.index_partition
+        self._set_asn_resolver(args.route_table, not args.no_whois)
+        # fork the parse workers before the probe, metadata and index threads start
+        self.parse_pool       = None
+        if self.parses and args.parse_processes:
+            self.parse_pool = parsepool.ParsePool(PROBES_FILE, args.parse_processes)
+        self.probes           = probe.Probes(args.refresh_probes, probes_file=PROBES_FILE,
+                cache_file=args.probe_cache, rir_files=args.delegated_stats,
+                lru_size=args.probe_lru_size)
         self.api_url          = args.url
 
+        self.index_threads    = args.index_threads
+        self.chunk_size       = args.chunk_size
+        self.max_chunk_bytes  = args.max_chunk_bytes
+        self.bulk_sizer       = bulkretry.BulkSizer(args.chunk_size, args.min_chunk_size)
+        self.max_retries      = args.max_retries
+        self.retry_backoff    = args.retry_backoff
+        self.dead_letter      = None
+        if args.dead_letter:
+            self.dead_letter = bulkretry.DeadLetter(args.dead_letter)
+        self.op_type          = args.op_type
+        self.metadata_threads = args.metadata_threads
+
         self._set_measurement_ids(args.measurement_ids)
         self._format_hosts(args.hosts)
+        self.client           = elasticsearch.Elasticsearch(hosts=self.hosts,
+                timeout=args.timeout, maxsize=max(self.index_threads, 10))
+        self.index_pool       = None
+        if self.index_threads > 1:
+            self.index_pool = multiprocessing.pool.ThreadPool(self.index_threads)
+        self.ndjson_dir       = args.ndjson_dir
+        self.index_manager    = indices.IndexManager(self.client,
+                self.bulk_load and not args.no_bulk_settings and not self.ndjson_dir,
+                args.index_partition)
+        if not args.no_templates and not self.ndjson_dir:
+            self.index_manager.install_templates()
+        self.ndjson_lock      = threading.Lock()
+        self.ndjson_count     = 0
+        if self.ndjson_dir and not os.path.isdir(self.ndjson_dir):
+            os.makedirs(self.ndjson_dir)
         
     def _set_measurement_ids(self, measurement_ids):
-        for measurement_id in measurement_ids:
-            self.logger.info('fetch msm metata data: {}'.format(measurement_id))
-            filters = {'msm_id': measurement_id }
-            measurements = MeasurementRequest(**filters)
-            self.measurement_ids[measurement_id] = measurements.next()
-            self.logger.debug('fetched msm metata data: {}\n{}'.format(
-                measurement_id, self.measurement_ids[measurement_id]))
+        '''start loading the measurement metadata, lookups wait for it to arrive'''
+        self.measurement_ids = metadata.MeasurementMetadata(probe.Probe.enrich_cache,
+                self.metadata_threads)
+        self.measurement_ids.load(measurement_ids)
 
+    def _set_asn_resolver(self, route_files, whois=True):
+        '''configure how traceroute hops are mapped to origin ASNs'''
+        route_table = None
+        if route_files:
+            route_table = routetable.RouteTable(route_files)
+        measuerments.MeasurmentTraceroute.asn_resolver = resolver.ASNResolver(
+                route_table=route_table, whois=whois)
 
     def _format_hosts(self, hosts):
         '''format the hosts argument into a json blob'''
+        self.hosts = []
         for host in hosts.split(','):
             tokens    = host.split(':',1)
             port      = 9200
@@ -55,44 +133,248 @@ class Processor(object):
                 'host' : host_name,
                 'port' : port })
 
-    def _index_items(self, actions, chunk_size=200, timeout=60):
-        self.logger.info('start: index {} actions'.format(len(actions)))
-        client = elasticsearch.Elasticsearch(hosts=self.hosts, timeout=timeout)
+    def _set_op_type(self, actions):
+        '''set the bulk operation of each action'''
+        for action in actions:
+            action['_op_type'] = self.op_type
+            yield action
+
+    def _encode(self, action):
+        '''return the bulk item of an action with the configured operation'''
+        action['_op_type'] = self.op_type
+        return bulkbody.BulkBody.encode(action)
+
+    def _bulk(self, actions):
+        '''index actions, returns (number indexed, list of (bulk item, status, error))'''
+        actions = self.index_manager.prepare(self._set_op_type(actions))
+        return self._bulk_items(itertools.imap(bulkbody.BulkBody.encode, actions))
+
+    def _bulk_items(self, items):
+        '''index encoded bulk items, returns (number indexed, list of (bulk item, status, error))'''
+        return self._send_bodies(bulkbody.BulkBody(max_bytes=self.max_chunk_bytes,
+            sizer=self.bulk_sizer).pack(items))
+
+    def _send_once(self, body, items):
+        '''send a bulk request body, returns (number indexed, items to retry,
+        items which failed) where the item lists hold (bulk item, status, error)'''
         try:
-            success, errors = elasticsearch.helpers.bulk(
-                client,
-                actions,
-                chunk_size=chunk_size)
-            self.logger.info('completed: index {} actions'.format(success))
-            if len(errors) > 0:
-                self.logger.error('problem inserting:\n{}'.format(errors))
-                self.logger.debug('actions\n{}'.format(action))
-        except elasticsearch.exceptions.ConnectionTimeout:
-            self.logger.error('Timed out submitting\n{}'.format(actions))
+            response = self.client.bulk(body=body)
+        except elasticsearch.exceptions.TransportError as e:
+            # connection errors have no http status and are worth retrying
+            status = e.status_code if isinstance(e.status_code, int) else None
+            if status == 429:
+                self.bulk_sizer.shrink()
+            failed = [(item, status, bulkretry.error_message(e)) for item in items]
+            if status is None or status in bulkretry.RETRY_STATUS:
+                return 0, failed, []
+            return 0, [], failed
+        indexed = 0
+        retry   = []
+        failed  = []
+        for item, result in zip(items, response['items']):
+            op_type, result = result.items()[0]
+            status          = result.get('status', 500)
+            # a create conflict means an earlier run already indexed the document
+            if 200 <= status < 300 or (status == 409 and op_type == 'create'):
+                indexed += 1
+            elif status in bulkretry.RETRY_STATUS:
+                retry.append((item, status, bulkretry.error_message(result.get('error', None))))
+            else:
+                failed.append((item, status, bulkretry.error_message(result.get('error', None))))
+        if any(status == 429 for item, status, error in retry):
+            self.bulk_sizer.shrink()
+        else:
+            self.bulk_sizer.grow()
+        return indexed, retry, failed
+
+    def _send(self, body):
+        '''send a bulk request body, retrying rejected items with exponential
+        backoff.  items which still fail are written to the dead letter file.
+        returns (number indexed, list of (bulk item, status, error))'''
+        body, items = body
+        success     = 0
+        errors      = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = min(self.retry_backoff * 2 ** (attempt - 1), MAX_BACKOFF)
+                self.logger.info('retrying {} rejected actions in {:.1f}s'.format(len(items), delay))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                body = bulkbody.BulkBody.join(items)
+            indexed, retry, failed = self._send_once(body, items)
+            success += indexed
+            errors  += failed
+            if not retry:
+                break
+            items = [item for item, status, error in retry]
+        else:
+            errors += retry
+        if self.dead_letter is not None:
+            self.dead_letter.write(errors)
+        return success, errors
+
+    def _write(self, body):
+        '''write a bulk request body to the ndjson directory, returns (number written, [])'''
+        body, items = body
+        with self.ndjson_lock:
+            self.ndjson_count += 1
+            path = os.path.join(self.ndjson_dir, 'bulk-{}-{:06d}.ndjson'.format(
+                os.getpid(), self.ndjson_count))
+        with open(path, 'wb') as ndjson:
+            ndjson.write(body)
+        return len(items), []
+
+    def _send_bodies(self, bodies):
+        '''send or write bulk request bodies, returns (number indexed, list of errors)'''
+        send    = self._write if self.ndjson_dir else self._send
+        success = 0
+        errors  = []
+        if self.index_pool is None:
+            results = itertools.imap(send, bodies)
+        else:
+            results = self._send_concurrently(send, bodies)
+        for body_success, body_errors in results:
+            success += body_success
+            errors  += body_errors
+        return success, errors
+
+    def _send_concurrently(self, send, bodies):
+        '''send bodies on the index pool, yields the results in order.  At most
+        two bodies per thread are encoded ahead of the requests'''
+        pending = collections.deque()
+        for body in bodies:
+            pending.append(self.index_pool.apply_async(send, (body,)))
+            if len(pending) >= self.index_threads * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _log_errors(self, errors):
+        '''log a summary of the actions which could not be indexed'''
+        statuses = collections.Counter(status for item, status, error in errors)
+        item, status, error = errors[0]
+        self.logger.error('unable to index {} actions {}{}, first error: {} {}'.format(
+            len(errors), dict(statuses),
+            ', written to {}'.format(self.dead_letter.path) if self.dead_letter is not None else '',
+            item[1].get('_id', None), error))
+
+    def _index_items(self, actions, encoded=False):
+        '''index an iterable of actions, or of bulk items if encoded is set,
+        returns False if anything failed.  actions written to the dead letter
+        file are handled unless they were rejected for a reason which may go
+        away, those are worth fetching again'''
+        self.logger.info('start: index actions')
+        success, errors = self._bulk_items(actions) if encoded else self._bulk(actions)
+        self.logger.info('completed: index {} actions'.format(success))
+        if errors:
+            self._log_errors(errors)
+            if self.dead_letter is None:
+                return False
+            return not any(status is None or status in bulkretry.RETRY_STATUS
+                    for item, status, error in errors)
+        return True
 
     @staticmethod
     def _get_measurement(measurement, probe):
-        return {
-                'dns': measuerments.MeasurmentDNS,
-                'traceroute': measuerments.MeasurmentTraceroute,
-                }.get(measurement['type'], measuerments.Measurment)(measurement, probe)
+        return measuerments.get_measurement(measurement, probe)
+
+    def _parse_batches(self, measurement_id, results, batch_size=500):
+        '''convert an iterable of raw results into index actions, in the parse
+        pool if there is one.  yields a list of actions per batch of results'''
+        counts  = []
+        batches = parsepool.batches(results, batch_size)
+        if self.parse_pool is not None:
+            parsed = self.parse_pool.imap(batches, counts)
+        else:
+            parsed = (parsepool.parse_results(batch, self.probes.get, counts) for batch in batches)
+        for actions, errors, missing in parsed:
+            for probe_id in missing:
+                if probe_id not in self.already_warned:
+                    self.logger.warning('{}:Unable to find Probe, skipping: {}'.format(measurement_id, probe_id))
+                    self.already_warned.append(probe_id)
+            for msm_id, probe_id, timestamp, message in errors:
+                self.logger.error('{}:unable to parse result from probe {} at {}:\n{}'.format(
+                    msm_id, probe_id, timestamp, message))
+            yield actions
+        self.logger.info('{}: parsed {} measuerments'.format(measurement_id, sum(counts)))
+
+    def _parse_results(self, measurement_id, results, batch_size=500):
+        '''lazily convert an iterable of raw results into index actions'''
+        return itertools.chain.from_iterable(
+                self._parse_batches(measurement_id, results, batch_size))
 
     @staticmethod
-    def add_args(parser):
+    def add_args(parser, measurement_ids=True):
         ''' add the default set of arguments to each sub parser so the cli documenbtation and use is more intuative'''
         parser.add_argument('--verbose', '-v', action='count')
         parser.add_argument('-H', '--hosts', default='localhost:9200',
                 help='elastic search backend servers')
+        parser.add_argument('--timeout', default=60, type=int,
+                help='elastic search request timeout in seconds. default: 60')
+        parser.add_argument('--index-threads', default=1, type=int,
+                help='number of parallel bulk indexing threads. default: 1')
+        parser.add_argument('--chunk-size', default=200, type=int,
+                help='maximum number of documents per bulk request. default: 200')
+        parser.add_argument('--max-chunk-bytes', default=10485760, type=int,
+                help='maximum size of a bulk request in bytes. default: 10485760')
+        parser.add_argument('--min-chunk-size', default=10, type=int,
+                help='smallest bulk request when elasticsearch rejects requests. default: 10')
+        parser.add_argument('--max-retries', default=5, type=int,
+                help='number of times rejected actions are retried. default: 5')
+        parser.add_argument('--retry-backoff', default=1.0, type=float,
+                help='seconds before the first retry, doubled for each further retry. default: 1')
+        parser.add_argument('--dead-letter', default=DEAD_LETTER_FILE,
+                help='file the actions which could not be indexed are appended to, empty to '
+                'disable. default: {}'.format(DEAD_LETTER_FILE))
+        parser.add_argument('--op-type', default='index', choices=['index', 'create'],
+                help='index overwrites documents which already exist, create skips them. default: index')
+        parser.add_argument('--index-partition', default='monthly', choices=sorted(indices.PARTITIONS),
+                help='split the atlas-<type> indices by the result time. default: monthly')
+        parser.add_argument('--no-templates', action='store_true',
+                help='do not install the bundled index templates')
+        parser.add_argument('--no-bulk-settings', action='store_true',
+                help='bulk, file and replay disable refresh and replicas on the indices they write '
+                'to until they finish, this keeps the index settings unchanged')
+        parser.add_argument('--ndjson-dir',
+                help='write the bulk request bodies to .ndjson files in this directory '
+                'instead of sending them to elasticsearch')
+        parser.add_argument('--metadata-threads', default=8, type=int,
+                help='number of measurement metadata requests made concurrently. default: 8')
+        parser.add_argument('--parse-processes', default=0, type=int,
+                help='latest, bulk, replay and file parse results in this many worker processes, '
+                '0 to parse in process. default: 0')
         parser.add_argument('--refresh-probes', action='store_true', 
                 help='Refresh the probe pickle data')
-        parser.add_argument('measurement_ids',  nargs='+',
-                help='measurement(s) to index in Elasticsearch')
+        parser.add_argument('--probe-cache', default='enrich-cache.db',
+                help='file used to cache probe metadata lookups')
+        parser.add_argument('--probe-lru-size', type=int,
+                help='number of decoded probes kept in memory. default: the number of known probes')
+        parser.add_argument('--delegated-stats', action='append',
+                help='RIR delegated stats file used to find the RIR of probe prefixes')
+        parser.add_argument('--route-table', action='append',
+                help='RIS/RouteViews prefix to origin dump used to map traceroute hops to ASNs')
+        parser.add_argument('--no-whois', action='store_true',
+                help='do not query shadowserver for hops missing from the route table')
+        if measurement_ids:
+            parser.add_argument('measurement_ids',  nargs='+',
+                    help='measurement(s) to index in Elasticsearch')
 
     def process(self):
         raise NotImplementedError('Subclasses should implement this!')
 
+    def close(self):
+        '''release resources held by the processor'''
+        self.index_manager.restore()
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+            self.parse_pool = None
+        if self.index_pool is not None:
+            self.index_pool.close()
+            self.index_pool = None
+
 class ProcessorLatest(Processor):
 
+    parses = True
+
     def __init__(self, args):
         super(ProcessorLatest, self).__init__(args)
         self.logger  = logging.getLogger('atlas-kibana.ProcessorLatest')
@@ -107,31 +389,47 @@ class ProcessorLatest(Processor):
                 default=url)
 
     def process(self):
-        actions = []
         for measurement_id, meta in self.measurement_ids.items():
             url = self.api_url.format(measurement_id)
             self.logger.info('fetching measuerments: {}'.format(url))
-            measurement_data = requests.get(url).json()
+            response = requests.get(url, stream=True)
+            response.raise_for_status()
+            measurement_data = jsonstream.iter_object(response.iter_content(65536))
+            self._index_items(self._parse_results(measurement_id,
+                    itertools.chain.from_iterable(results for probe_id, results in measurement_data)))
             self.logger.info('finished fetching measuerments: {}'.format(url))
-            for probe_id, measurement_json in measurement_data.items():
-                self.logger.info('Fetch probe {}'.format(probe_id))
-                probe = self.probes.get(probe_id)
-                if not probe:
-                    self.logger.warning('{}:Unable to find Probe, skipping: {}'.format(measurement_id, probe_id))
-                    continue
-                for m in measurement_json:
-                    measurement = self._get_measurement(m, probe)
-                    actions += measurement.get_actions()
-            self._index_items(actions)
 
 class ProcessorBulk(Processor):
 
+    bulk_load = True
+    parses    = True
+
     def __init__(self, args):
         super(ProcessorBulk, self).__init__(args)
-        self.logger       = logging.getLogger('atlas-kibana.ProcessorBulk')
-        self.start_time   = args.start_time
-        self.stop_time    = min(args.stop_time, int(time.time()))
-        self.chunk_period = args.chunk_period
+        self.logger        = logging.getLogger('atlas-kibana.ProcessorBulk')
+        self.start_time    = args.start_time
+        self.stop_time     = min(args.stop_time, int(time.time()))
+        self.chunk_period  = args.chunk_period
+        self.fetch_workers = args.fetch_workers
+        self.parse_workers = args.parse_workers
+        self.index_workers = args.index_workers
+        self.queue_size    = args.queue_size
+        self.chunk_sizer    = None
+        self.checkpoint_dir = args.checkpoint_dir
+        self.shard, self.shards = args.shard or (0, 1)
+        if self.shards > 1:
+            # shards on one host must not share checkpoint files
+            self.checkpoint_dir = os.path.join(self.checkpoint_dir,
+                    'shard-{}-of-{}'.format(self.shard + 1, self.shards))
+        self.resume         = args.resume
+        self.checkpoints    = dict()
+        self.checkpoint_lock = threading.Lock()
+        self.archive        = None
+        if args.archive_dir:
+            self.archive = archive.Archive(args.archive_dir)
+        if args.adaptive_chunks:
+            self.chunk_sizer = chunksizer.ChunkSizer(args.target_chunk_bytes,
+                    args.min_chunk_period, args.max_chunk_period, args.max_fetch_time)
         if self.stop_time < self.start_time:
             raise ValueError('stop time ({}) is before start time ({})'.format(self.start_time, self.stop_time))
 
@@ -149,45 +447,237 @@ class ProcessorBulk(Processor):
                 help='get measuerment upto this date in unix time')
         parser.add_argument('--chunk-period', default=86400, type=int,
                 help='to save on memory we fetch data in chunks.  value in seconds default: 86400')
+        parser.add_argument('--fetch-workers', default=4, type=int,
+                help='number of chunks to download concurrently. default: 4')
+        parser.add_argument('--parse-workers', default=1, type=int,
+                help='number of chunks to parse concurrently. default: 1')
+        parser.add_argument('--index-workers', default=1, type=int,
+                help='number of chunks to index concurrently. default: 1')
+        parser.add_argument('--queue-size', default=4, type=int,
+                help='number of chunks buffered between each stage. default: 4')
+        parser.add_argument('--checkpoint-dir', default='checkpoints',
+                help='directory holding the per measurement checkpoint files. default: checkpoints')
+        parser.add_argument('--resume', action='store_true',
+                help='continue from the checkpoint files and retry the chunks which failed')
+        parser.add_argument('--shard', type=shard,
+                help='only process the i-th of N shards of the time windows, e.g. 2/4.  every shard '
+                'must be run with the same arguments')
+        parser.add_argument('--archive-dir',
+                help='append the raw results to a local archive in this directory for the replay command')
+        parser.add_argument('--adaptive-chunks', action='store_true',
+                help='size each chunk from the size and fetch time of the previous one, '
+                'starting at --chunk-period')
+        parser.add_argument('--target-chunk-bytes', default=33554432, type=int,
+                help='response size adaptive chunks aim for. default: 33554432')
+        parser.add_argument('--min-chunk-period', default=300, type=int,
+                help='shortest adaptive chunk in seconds. default: 300')
+        parser.add_argument('--max-chunk-period', default=2592000, type=int,
+                help='longest adaptive chunk in seconds. default: 2592000')
+        parser.add_argument('--max-fetch-time', default=120, type=int,
+                help='shrink adaptive chunks which take longer than this to fetch. default: 120')
 
-    def process(self):
-        for measurement_id, meta in self.measurement_ids.items():
-            self.logger.info('process measurement: {}'.format(measurement_id))
-            start_time       = max(self.start_time, self.measurement_ids[measurement_id]['creation_time'])
-            chunk_stop_time  = start_time + self.chunk_period
-            chunk_start_time = start_time
-            while chunk_start_time < self.stop_time:
-                actions = []
-                url     = self.api_url.format(measurement_id, chunk_start_time, chunk_stop_time)
-                self.logger.info('fetching measuerments: {}'.format(url))
-                measurement_data = requests.get(url).json()
-                self.logger.info('finished fetching measuerments: {}'.format(url))
-                count = 0
-                for measurement_json in measurement_data:
-                    probe_id = measurement_json['prb_id']
-                    self.logger.debug('{}:Fetch probe {}'.format(measurement_id, probe_id))
-                    probe = self.probes.get(probe_id)
-                    if not probe:
-                        if probe_id not in self.already_warned:
-                            self.logger.warning('{}:Unable to find Probe, skipping: {}'.format(measurement_id, probe_id))
-                            self.already_warned.append(probe_id)
-                        continue
-                    measurement = self._get_measurement(measurement_json, probe)
-                    actions    += measurement.get_actions()
-                    count      += 1
-                    if not count % 1000:
-                        self.logger.info('{}: parsed {} measuerments'.format(measurement_id, count)) 
+    def _checkpoint(self, measurement_id):
+        '''return the checkpoint of a measurement, creating it once its metadata
+        has loaded.  raises KeyError if the metadata could not be loaded'''
+        with self.checkpoint_lock:
+            if measurement_id not in self.checkpoints:
+                msm_checkpoint = checkpoint.Checkpoint(measurement_id, self.checkpoint_dir,
+                        self._start(measurement_id))
+                if self.resume:
+                    msm_checkpoint.load()
+                self.checkpoints[measurement_id] = msm_checkpoint
+            return self.checkpoints[measurement_id]
 
-                self._index_items(actions)
+    def _start(self, measurement_id):
+        '''return the time to start fetching a measurement from'''
+        return max(self.start_time, self.measurement_ids[measurement_id]['creation_time'])
+
+    def _owns(self, measurement_id, index):
+        '''check if the index-th window of a measurement belongs to this shard.
+        the offset spreads the first windows of each measurement over the shards'''
+        offset = zlib.crc32(str(measurement_id)) & 0xffffffff
+        return (index + offset) % self.shards == self.shard
+
+    def _windows(self, measurement_id, period=None):
+        '''yield the (start, stop) time windows of this shard to fetch for a
+        measurement, starting with the windows which failed in a previous run
+        and skipping the windows which were already indexed'''
+        period         = period or self.chunk_period
+        msm_checkpoint = self.checkpoints[measurement_id]
+        failed         = list(msm_checkpoint.failed)
+        for start, stop in failed:
+            yield start, stop
+        chunk_start_time = self._start(measurement_id)
+        chunk_stop_time  = chunk_start_time + period
+        index            = 0
+        while chunk_start_time < self.stop_time:
+            if self._owns(measurement_id, index) and (chunk_start_time, chunk_stop_time) not in failed and \
+                    not msm_checkpoint.is_completed(chunk_start_time, chunk_stop_time):
+                yield chunk_start_time, chunk_stop_time
+            chunk_start_time = chunk_stop_time + 1
+            chunk_stop_time  = chunk_stop_time + period
+            index           += 1
+
+    def _segments(self, measurement_id):
+        '''return the (start, stop) ranges of this shard which adaptive chunks
+        are walked over.  without sharding that is the whole time range, with
+        sharding the range is cut into --max-chunk-period segments which are
+        dealt out to the shards like fixed windows'''
+        if self.shards == 1:
+            return [(self._start(measurement_id), self.stop_time)]
+        return [(start, stop) for start, stop in self._windows(measurement_id,
+            self.chunk_sizer.max_period) if (start, stop) not in self.checkpoints[measurement_id].failed]
+
+    def _measurement_chunks(self, measurement_id):
+        '''yield the units of work for a measurement'''
+        try:
+            msm_checkpoint = self._checkpoint(measurement_id)
+        except KeyError:
+            return
+        for start, stop in self._windows(measurement_id):
+            yield checkpoint.ChunkState(measurement_id, start, stop, msm_checkpoint)
+
+    def _chunks(self):
+        '''yield the units of work, interleaving the measurements so they are
+        fetched concurrently'''
+        windows = [self._measurement_chunks(measurement_id)
+                for measurement_id in self.measurement_ids]
+        while windows:
+            for window in list(windows):
+                try:
+                    yield next(window)
+                except StopIteration:
+                    windows.remove(window)
+
+    def _download(self, measurement_id, start, stop):
+        '''download the results of a time window into a spooled file,
+        returns (file, size in bytes, seconds taken)'''
+        url = self.api_url.format(measurement_id, start, stop)
+        self.logger.info('fetching measuerments: {}'.format(url))
+        fetch_start      = time.time()
+        measurement_data = jsonstream.spool_response(requests.get(url, stream=True))
+        fetch_time       = time.time() - fetch_start
+        measurement_data.seek(0, 2)
+        size             = measurement_data.tell()
+        measurement_data.seek(0)
+        self.logger.info('finished fetching measuerments: {} ({} bytes in {:.1f}s)'.format(
+            url, size, fetch_time))
+        return measurement_data, size, fetch_time
+
+    def _fetch(self, chunk):
+        '''pipeline stage: download the results of a time window'''
+        try:
+            measurement_data, size, fetch_time = self._download(
+                    chunk.measurement_id, chunk.start, chunk.stop)
+        except (requests.exceptions.RequestException, IOError) as e:
+            self.logger.error('{}: unable to fetch {} - {}: {}'.format(
+                chunk.measurement_id, chunk.start, chunk.stop, e))
+            chunk.parse_done(False)
+            return []
+        return [(chunk, measurement_data)]
+
+    def _fetch_adaptive(self, measurement_id):
+        '''pipeline stage: download the windows of a measurement in this shard,
+        sizing each window from the response to the previous one'''
+        try:
+            msm_checkpoint = self._checkpoint(measurement_id)
+        except KeyError:
+            return
+        failed         = list(msm_checkpoint.failed)
+        for start, stop in failed:
+            for item in self._fetch(checkpoint.ChunkState(measurement_id, start, stop, msm_checkpoint)):
+                yield item
+        period = self.chunk_period
+        for segment_start, segment_stop in self._segments(measurement_id):
+            segment_stop     = min(segment_stop, self.stop_time)
+            chunk_start_time = segment_start
+            while True:
+                chunk_start_time = msm_checkpoint.skip_completed(chunk_start_time, failed)
+                if chunk_start_time >= segment_stop:
+                    break
+                chunk_stop_time = min(chunk_start_time + period, segment_stop)
+                chunk = checkpoint.ChunkState(measurement_id, chunk_start_time, chunk_stop_time,
+                        msm_checkpoint)
+                try:
+                    measurement_data, size, fetch_time = self._download(
+                            measurement_id, chunk_start_time, chunk_stop_time)
+                except (requests.exceptions.RequestException, IOError) as e:
+                    self.logger.error('{}: unable to fetch {} - {}: {}'.format(
+                        measurement_id, chunk_start_time, chunk_stop_time, e))
+                    chunk.parse_done(False)
+                else:
+                    yield chunk, measurement_data
+                    period = self.chunk_sizer.next_period(
+                            chunk_stop_time - chunk_start_time, size, fetch_time)
                 chunk_start_time = chunk_stop_time + 1
-                chunk_stop_time  = chunk_stop_time + self.chunk_period
+
+    def _parse(self, item):
+        '''pipeline stage: convert results into batches of index actions'''
+        chunk, measurement_data = item
+        ok = False
+        try:
+            with measurement_data:
+                results = jsonstream.iter_array(jsonstream.iter_chunks(measurement_data))
+                if self.archive is not None:
+                    results = self.archive.record(results)
+                for actions in self._parse_batches(chunk.measurement_id, results):
+                    chunk.add_batch()
+                    yield chunk, actions
+            ok = True
+        except (jsonstream.JSONStreamError, IOError) as e:
+            self.logger.error('{}: unable to decode {} - {}: {}'.format(
+                chunk.measurement_id, chunk.start, chunk.stop, e))
+        finally:
+            chunk.parse_done(ok)
+
+    def _index(self, item):
+        '''pipeline stage: index a batch of actions of a time window'''
+        chunk, actions = item
+        ok = False
+        try:
+            ok = self._index_items(actions)
+        finally:
+            chunk.batch_done(ok)
+
+    def process(self):
+        # checkpoints are created as the metadata of each measurement arrives
+        if self.chunk_sizer is not None:
+            # windows depend on the previous response so each measurement is walked by one fetcher
+            fetch, work = self._fetch_adaptive, list(self.measurement_ids)
+        else:
+            fetch, work = self._fetch, self._chunks()
+        stages = [
+                pipeline.Stage('fetch', fetch, self.fetch_workers),
+                pipeline.Stage('parse', self._parse, self.parse_workers),
+                pipeline.Stage('index', self._index, self.index_workers),
+                ]
+        errors = pipeline.Pipeline(stages, self.queue_size).run(work)
+        if errors:
+            self.logger.error('{} chunks failed to process'.format(errors))
+        for measurement_id, msm_checkpoint in self.checkpoints.items():
+            if msm_checkpoint.failed:
+                self.logger.error('{}: {} chunks failed, rerun with --resume to retry them'.format(
+                    measurement_id, len(msm_checkpoint.failed)))
 
 class ProcessorStream(Processor):
 
-    actions = []
     def __init__(self, args):
         super(ProcessorStream, self).__init__(args)
-        self.logger  = logging.getLogger('atlas-kibana.ProcessorStream')
+        self.logger   = logging.getLogger('atlas-kibana.ProcessorStream')
+        self.archive  = None
+        if args.archive_dir:
+            self.archive = archive.Archive(args.archive_dir)
+        # the sink encodes each action once, for its size and the bulk request
+        self.sink     = streamsink.StreamSink(self._index_encoded, args.flush_actions,
+                args.flush_bytes, args.flush_interval, args.queue_size, self.archive,
+                self._encode)
+        self.connections  = args.connections
+        self.max_backoff  = args.max_backoff
+        self.backfill_url = args.backfill_url
+        self.max_backfill = args.max_backfill
+        self.backfills    = Queue.Queue()
+        if args.probe_refresh_interval:
+            self.probes.start_refresh(args.probe_refresh_interval)
 
     @staticmethod
     def add_args(subparsers):
@@ -197,26 +687,255 @@ class ProcessorStream(Processor):
         parser.add_argument('-U', '--url',
                 help='api url to use ({})'.format(url),
                 default=url)
+        parser.add_argument('--probe-refresh-interval', default=86400, type=int,
+                help='refresh changed probes every n seconds, 0 to disable. default: 86400')
+        parser.add_argument('--archive-dir',
+                help='append the raw results to a local archive in this directory for the replay command')
+        parser.add_argument('--flush-actions', default=200, type=int,
+                help='index once this many actions are buffered. default: 200')
+        parser.add_argument('--flush-bytes', default=5242880, type=int,
+                help='index once this many bytes of documents are buffered. default: 5242880')
+        parser.add_argument('--flush-interval', default=5, type=float,
+                help='index buffered actions after at most this many seconds. default: 5')
+        parser.add_argument('--queue-size', default=4, type=int,
+                help='number of flushed batches waiting to be indexed before the stream '
+                'is paused. default: 4')
+        parser.add_argument('--connections', default=1, type=int,
+                help='spread the measurement subscriptions over this many connections. default: 1')
+        parser.add_argument('--max-backoff', default=300, type=int,
+                help='longest wait in seconds between reconnection attempts. default: 300')
+        parser.add_argument('--backfill-url', default=ATLAS_BULK_API,
+                help='api url used to fetch results missed while disconnected ({})'.format(ATLAS_BULK_API))
+        parser.add_argument('--max-backfill', default=86400, type=int,
+                help='backfill at most this many seconds after a disconnect, 0 to disable. default: 86400')
 
     def _process_measurement(self, measurement_json):
+        result = None
+        if self.archive is not None:
+            # archive every result, including the ones which can not be parsed
+            # yet, parsing modifies the top level of the result
+            result = dict(measurement_json)
         probe_id = measurement_json['prb_id']
-        self.logger.debug('Fetch probe {}'.format(probe_id))
-        probe = self.probes.get(probe_id)
-        if not probe:
-            if probe_id not in self.already_warned:
+        actions  = []
+        try:
+            self.logger.debug('Fetch probe {}'.format(probe_id))
+            probe = self.probes.get(probe_id)
+            if probe:
+                actions = list(self._get_measurement(measurement_json, probe).get_actions())
+            elif probe_id not in self.already_warned:
                 self.logger.warning('Unable to find Probe, skipping: {}'.format(probe_id))
                 self.already_warned.append(probe_id)
+            if actions or result is not None:
+                self.sink.add(actions, result)
+        except Exception as e:
+            # a bad result must not drop the connection or stop a backfill
+            self.logger.exception('{}: unable to process result of probe {} at {}: {}'.format(
+                measurement_json.get('msm_id', None), probe_id,
+                measurement_json.get('timestamp', None), e))
+            if result is not None:
+                self.sink.add([], result)
+
+    def _index_encoded(self, items):
+        '''index the bulk items flushed by the sink'''
+        return self._index_items(items, encoded=True)
+
+    def _gap(self, measurement_id, start, stop):
+        '''queue the results missed while a connection was down for backfilling'''
+        if not self.max_backfill:
             return
-        measurement   = self._get_measurement(measurement_json, probe)
-        self.actions += measurement.get_actions()
-        if len(self.actions) == 200:
-            self._index_items(self.actions)
-            self.actions = []
-            
-        
+        if stop - start > self.max_backfill:
+            self.logger.warning('{}: only backfilling the last {}s of a {}s gap'.format(
+                measurement_id, self.max_backfill, stop - start))
+            start = stop - self.max_backfill
+        self.backfills.put((measurement_id, start, stop))
+
+    def _backfill(self):
+        '''fetch the results of gaps from the bulk api and feed them to the sink'''
+        while True:
+            measurement_id, start, stop = self.backfills.get()
+            url = self.backfill_url.format(measurement_id, start, stop)
+            self.logger.info('backfilling measuerments: {}'.format(url))
+            try:
+                with jsonstream.spool_response(requests.get(url, stream=True)) as measurement_data:
+                    for result in jsonstream.iter_array(jsonstream.iter_chunks(measurement_data)):
+                        self._process_measurement(result)
+            except (requests.exceptions.RequestException, jsonstream.JSONStreamError, IOError) as e:
+                self.logger.error('{}: unable to backfill {} - {}: {}'.format(
+                    measurement_id, start, stop, e))
+            except Exception as e:
+                # keep the thread alive for the next gap
+                self.logger.exception('{}: unable to backfill {} - {}: {}'.format(
+                    measurement_id, start, stop, e))
+
+    def process(self):
+        backfill        = threading.Thread(target=self._backfill, name='stream-backfill')
+        backfill.daemon = True
+        backfill.start()
+        connections = []
+        for index, measurement_ids in enumerate(streamclient.split(
+                list(self.measurement_ids), self.connections)):
+            connection = streamclient.StreamConnection(self.api_url, measurement_ids,
+                    self._process_measurement, self._gap, 'stream-{}'.format(index),
+                    max_backoff=self.max_backoff)
+            connection.start()
+            connections.append(connection)
+        try:
+            # connections only stop when asked, wait with a timeout so KeyboardInterrupt is delivered
+            while any(connection.thread.is_alive() for connection in connections):
+                time.sleep(1)
+        finally:
+            for connection in connections:
+                connection.stop()
+
+    def close(self):
+        '''index the buffered actions before shutting down'''
+        self.sink.close()
+        super(ProcessorStream, self).close()
+
+
+class ProcessorReplay(Processor):
+
+    bulk_load = True
+    parses    = True
+
+    def __init__(self, args):
+        super(ProcessorReplay, self).__init__(args)
+        self.logger     = logging.getLogger('atlas-kibana.ProcessorReplay')
+        self.archive    = archive.Archive(args.archive_dir)
+        self.start_time = args.start_time
+        self.stop_time  = args.stop_time
+
+    def _set_measurement_ids(self, measurement_ids):
+        '''replay only needs the ids, so skip fetching the measurement metadata'''
+        self.measurement_ids = dict()
+        for measurement_id in measurement_ids:
+            self.measurement_ids[measurement_id] = dict()
+
+    @staticmethod
+    def add_args(subparsers):
+        parser = subparsers.add_parser('replay', help='index results from the local archive')
+        super(ProcessorReplay, ProcessorReplay).add_args(parser)
+        parser.set_defaults(url=None)
+        parser.add_argument('--archive-dir', default=ARCHIVE_DIR,
+                help='directory holding the archived results. default: {}'.format(ARCHIVE_DIR))
+        parser.add_argument('--start-time', type=int,
+                help='replay measuerments from this date in unix time')
+        parser.add_argument('--stop-time', type=int,
+                help='replay measuerments upto this date in unix time')
+
     def process(self):
-        s = socketIO_client.SocketIO('atlas-stream.ripe.net/stream', 80, socketIO_client.LoggingNamespace)
-        s.on('atlas_result', self._process_measurement)
         for measurement_id in self.measurement_ids:
-            s.emit('atlas_subscribe', { 'stream_type': 'atlas_result', 'msm': measurement_id })
-        s.wait()
+            days = self.archive.days(measurement_id, self.start_time, self.stop_time)
+            if not days:
+                self.logger.warning('{}: nothing archived to replay'.format(measurement_id))
+                continue
+            self.logger.info('{}: replaying {} days from {} to {}'.format(
+                measurement_id, len(days), days[0], days[-1]))
+            for actions in self._parse_batches(measurement_id,
+                    self.archive.read(measurement_id, self.start_time, self.stop_time)):
+                self._index_items(actions)
+
+
+class ProcessorFile(Processor):
+
+    bulk_load = True
+    parses    = True
+
+    def __init__(self, args):
+        super(ProcessorFile, self).__init__(args)
+        self.logger        = logging.getLogger('atlas-kibana.ProcessorFile')
+        self.paths         = args.paths
+        self.read_workers  = args.read_workers
+        self.index_workers = args.index_workers
+        self.queue_size    = args.queue_size
+        self.shard, self.shards = args.shard or (0, 1)
+        self.failed        = []
+
+    def _set_measurement_ids(self, measurement_ids):
+        '''the measurement ids only filter the results, so skip fetching the metadata'''
+        self.measurement_ids = set(str(measurement_id) for measurement_id in measurement_ids or [])
+
+    @staticmethod
+    def add_args(subparsers):
+        parser = subparsers.add_parser('file', help='index results from local dump files')
+        super(ProcessorFile, ProcessorFile).add_args(parser, measurement_ids=False)
+        parser.set_defaults(url=None)
+        parser.add_argument('-m', '--measurement-ids', nargs='+',
+                help='only index the results of these measurements')
+        parser.add_argument('--read-workers', default=2, type=int,
+                help='number of files read concurrently. default: 2')
+        parser.add_argument('--index-workers', default=1, type=int,
+                help='number of batches indexed concurrently. default: 1')
+        parser.add_argument('--queue-size', default=4, type=int,
+                help='number of batches buffered between reading and indexing. default: 4')
+        parser.add_argument('--shard', type=shard,
+                help='only process the i-th of N shards of the files, e.g. 2/4')
+        parser.add_argument('paths', nargs='+',
+                help='result files or directories of result files, plain, gzip or bz2 '
+                'compressed json arrays or json lines')
+
+    def _results(self, path):
+        '''yield the results of a file which pass the measurement filter'''
+        for result in dumpfile.iter_results(path):
+            if not self.measurement_ids or str(result.get('msm_id', None)) in self.measurement_ids:
+                yield result
+
+    def _read(self, path):
+        '''pipeline stage: convert the results of a file into batches of index actions'''
+        self.logger.info('reading {}'.format(path))
+        try:
+            for actions in self._parse_batches(path, self._results(path)):
+                yield actions
+        except (jsonstream.JSONStreamError, IOError, EOFError, ValueError) as e:
+            self.logger.error('{}: unable to read: {}'.format(path, e))
+            self.failed.append(path)
+
+    def _index(self, actions):
+        '''pipeline stage: index a batch of actions'''
+        self._index_items(actions)
+
+    def process(self):
+        files = [path for index, path in enumerate(dumpfile.find_files(self.paths))
+                if index % self.shards == self.shard]
+        self.logger.info('indexing {} files'.format(len(files)))
+        stages = [
+                pipeline.Stage('read', self._read, self.read_workers),
+                pipeline.Stage('index', self._index, self.index_workers),
+                ]
+        errors = pipeline.Pipeline(stages, self.queue_size).run(files)
+        if errors:
+            self.logger.error('{} batches failed to process'.format(errors))
+        if self.failed:
+            self.logger.error('unable to read {} files:\n{}'.format(len(self.failed), '\n'.join(self.failed)))
+
+
+class ProcessorRetry(Processor):
+
+    def __init__(self, args):
+        super(ProcessorRetry, self).__init__(args)
+        self.logger = logging.getLogger('atlas-kibana.ProcessorRetry')
+        self.files  = args.files
+        if self.dead_letter is not None and self.dead_letter.path in self.files:
+            raise ValueError('the dead letter file {} is also being retried, choose another '
+                    'with --dead-letter'.format(self.dead_letter.path))
+
+    def _set_measurement_ids(self, measurement_ids):
+        '''dead letter files hold finished documents, no measurement metadata is needed'''
+        self.measurement_ids = dict()
+
+    @staticmethod
+    def add_args(subparsers):
+        parser = subparsers.add_parser('retry', help='index the actions of dead letter files again')
+        super(ProcessorRetry, ProcessorRetry).add_args(parser, measurement_ids=False)
+        parser.set_defaults(url=None, measurement_ids=None, dead_letter='dead-letter-retry.jsonl')
+        parser.add_argument('files', nargs='+',
+                help='dead letter files written by --dead-letter')
+
+    def process(self):
+        for path in self.files:
+            self.logger.info('retrying {}'.format(path))
+            success, errors = self._send_bodies(bulkbody.BulkBody(max_bytes=self.max_chunk_bytes,
+                sizer=self.bulk_sizer).pack(bulkretry.DeadLetter.read(path)))
+            self.logger.info('{}: indexed {} actions'.format(path, success))
+            if errors:
+                self._log_errors(errors)
@@ -0,0 +1,106 @@
+import cache
+import logging
+import libwhois
+import threading
+
+class ASNResolver(object):
+    '''Resolve IP addresses to libwhois.ASNRecord's using an optional local
+    routetable.RouteTable and bulk shadowserver queries.  Whois results,
+    including addresses without an origin, are kept in an LRU cache.  Addresses
+    of failed queries are cached as unknown for failure_ttl seconds'''
+
+    def __init__(self, ttl=86400, negative_ttl=3600, size=262144, batch_size=1000,
+            route_table=None, whois=True, failure_ttl=300):
+        '''initialise class'''
+        self.logger       = logging.getLogger('atlas-kibana.ASNResolver')
+        self.route_table  = route_table
+        self.whois        = whois
+        self.ttl          = ttl
+        self.negative_ttl = negative_ttl
+        self.failure_ttl  = failure_ttl
+        self.batch_size   = batch_size
+        self.cache        = cache.Cache(None, ttl=ttl, size=size)
+        self.lock         = threading.Lock()
+        self.pending      = dict()
+        self.queries      = 0
+
+    def _cached(self, ips):
+        '''split ips into a dict of cached results and a list of unknown ips'''
+        result  = dict()
+        missing = []
+        for ip in ips:
+            try:
+                result[ip] = self.cache.get('origin', ip)
+            except KeyError:
+                missing.append(ip)
+        return result, missing
+
+    def _query(self, ips):
+        '''perform one bulk whois query and cache the results'''
+        asn_whois       = libwhois.ASNWhois()
+        asn_whois.query = ips
+        self.queries   += 1
+        self.logger.debug('query origin for {} addresses'.format(len(ips)))
+        records = asn_whois.result
+        for ip in ips:
+            record = records.get(ip)
+            if record is None:
+                self.cache.set('origin', ip, None, self.negative_ttl)
+            else:
+                self.cache.set('origin', ip, record)
+
+    def _local(self, ips):
+        '''split ips into a dict of route table results and a list of unknown ips'''
+        result  = dict()
+        missing = []
+        for ip in ips:
+            record = self.route_table.lookup(ip) if self.route_table else None
+            if record is None:
+                missing.append(ip)
+            else:
+                result[ip] = record
+        return result, missing
+
+    def prefetch(self, ips):
+        '''resolve all unknown ips using as few whois queries as possible'''
+        if not self.whois:
+            return
+        ips     = set(ip for ip in self._local(ips)[1] if libwhois.is_ip(ip))
+        missing = self._cached(ips)[1]
+        if not missing:
+            return
+        # query the addresses no other thread is querying, wait for the rest
+        done = threading.Event()
+        with self.lock:
+            waits   = set(self.pending[ip] for ip in missing if ip in self.pending)
+            claimed = [ip for ip in missing if ip not in self.pending]
+            for ip in claimed:
+                self.pending[ip] = done
+        try:
+            # another thread may have finished querying them meanwhile
+            missing = self._cached(claimed)[1]
+            for index in range(0, len(missing), self.batch_size):
+                batch = missing[index:index + self.batch_size]
+                try:
+                    self._query(batch)
+                except (libwhois.QueryError, IOError) as e:
+                    self.logger.warning('unable to query origin for {} addresses: {}'.format(
+                        len(batch), e))
+                    for ip in batch:
+                        self.cache.set('origin', ip, None, self.failure_ttl)
+        finally:
+            with self.lock:
+                for ip in claimed:
+                    self.pending.pop(ip, None)
+            done.set()
+        for wait in waits:
+            wait.wait()
+
+    def resolve(self, ips):
+        '''return a dict of ip -> ASNRecord, addresses without an origin are left out'''
+        result, missing = self._local(ips)
+        if missing and self.whois:
+            self.prefetch(missing)
+            cached = self._cached(missing)[0]
+            result.update((ip, record) for ip, record in cached.items() if record is not None)
+        return result
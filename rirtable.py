@@ -0,0 +1,92 @@
+import bz2
+import gzip
+import bisect
+import netaddr
+import logging
+
+class RIRTable(object):
+    '''Interval table of address delegations built from the RIR
+    delegated(-extended) stats files, used to find the RIR of a prefix'''
+
+    # use the same names as the RIPEstat whois authorities
+    registries = {'ripencc': 'ripe'}
+    statuses   = frozenset(['allocated', 'assigned'])
+
+    def __init__(self, files=None):
+        '''initialise class'''
+        self.logger    = logging.getLogger('atlas-kibana.RIRTable')
+        self.intervals = {4: [], 6: []}
+        self.starts    = {4: [], 6: []}
+        for stats_file in files or []:
+            self.load(stats_file)
+        self._sort()
+
+    def __len__(self):
+        '''number of delegations in the table'''
+        return sum(len(intervals) for intervals in self.intervals.values())
+
+    @staticmethod
+    def _open(stats_file):
+        '''open a plain, gzip or bz2 file'''
+        if stats_file.endswith('.gz'):
+            return gzip.open(stats_file, 'rb')
+        if stats_file.endswith('.bz2'):
+            return bz2.BZ2File(stats_file, 'rb')
+        return open(stats_file, 'rb')
+
+    def _parse_line(self, line):
+        '''return (version, first, last, rir) from a delegated stats line or None'''
+        tokens = line.strip().split('|')
+        if len(tokens) < 7 or tokens[2] not in ('ipv4', 'ipv6') or tokens[6] not in self.statuses:
+            return None
+        registry = self.registries.get(tokens[0], tokens[0])
+        if tokens[2] == 'ipv4':
+            first = netaddr.IPAddress(tokens[3]).value
+            return 4, first, first + int(tokens[4]) - 1, registry
+        network = netaddr.IPNetwork('{}/{}'.format(tokens[3], tokens[4]))
+        return 6, network.first, network.last, registry
+
+    def load(self, stats_file):
+        '''load a delegated stats file'''
+        self.logger.info('loading delegations from {}'.format(stats_file))
+        count = 0
+        with self._open(stats_file) as stats:
+            for line in stats:
+                if line.startswith('#'):
+                    continue
+                try:
+                    entry = self._parse_line(line)
+                except (netaddr.AddrFormatError, ValueError):
+                    self.logger.debug('skipping delegation line: {}'.format(line.strip()))
+                    continue
+                if entry is None:
+                    continue
+                version, first, last, registry = entry
+                self.intervals[version].append((first, last, registry))
+                count += 1
+        self.logger.info('loaded {} delegations from {}'.format(count, stats_file))
+
+    def _sort(self):
+        '''sort the intervals so they can be searched with bisect'''
+        for version, intervals in self.intervals.items():
+            intervals.sort()
+            self.starts[version] = [interval[0] for interval in intervals]
+
+    def lookup(self, prefix):
+        '''return the comma separated RIR(s) covering prefix or None'''
+        try:
+            network = netaddr.IPNetwork(prefix)
+        except (netaddr.AddrFormatError, ValueError):
+            return None
+        intervals  = self.intervals[network.version]
+        starts     = self.starts[network.version]
+        index      = max(bisect.bisect_right(starts, network.first) - 1, 0)
+        registries = []
+        while index < len(intervals) and intervals[index][0] <= network.last:
+            first, last, registry = intervals[index]
+            if last >= network.first and registry not in registries:
+                registries.append(registry)
+            index += 1
+        if not registries:
+            return None
+        return ','.join(registries)
@@ -0,0 +1,108 @@
+import bz2
+import gzip
+import socket
+import logging
+import binascii
+import libwhois
+
+class RouteTable(object):
+    '''Longest prefix match table of prefix -> origin asn for IPv4 and IPv6.
+
+    Loaded from RIS riswhois dumps (asn prefix peers) or RouteViews/CAIDA
+    pfx2as files (network length asn).  Each address family keeps a dict of
+    network -> origin per prefix length, a lookup masks the address with each
+    known prefix length from longest to shortest'''
+
+    families = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+    def __init__(self, files=None):
+        '''initialise class'''
+        self.logger   = logging.getLogger('atlas-kibana.RouteTable')
+        self.prefixes = {4: dict(), 6: dict()}
+        self.lengths  = {4: [], 6: []}
+        for route_file in files or []:
+            self.load(route_file)
+
+    def __len__(self):
+        '''number of prefixes in the table'''
+        return sum(len(networks) for family in self.prefixes.values()
+                for networks in family.values())
+
+    @staticmethod
+    def _open(route_file):
+        '''open a plain, gzip or bz2 file'''
+        if route_file.endswith('.gz'):
+            return gzip.open(route_file, 'rb')
+        if route_file.endswith('.bz2'):
+            return bz2.BZ2File(route_file, 'rb')
+        return open(route_file, 'rb')
+
+    @classmethod
+    def _to_int(cls, address):
+        '''return (version, int) for an ip address string'''
+        version = 6 if ':' in address else 4
+        packed  = socket.inet_pton(cls.families[version][0], address)
+        return version, int(binascii.hexlify(packed), 16)
+
+    @staticmethod
+    def _parse_line(line):
+        '''return (prefix, origin) from a dump line or None'''
+        tokens = line.split()
+        if len(tokens) < 2 or tokens[0][0] in '%#;':
+            return None
+        if '/' in tokens[1]:
+            origin, prefix = tokens[0], tokens[1]
+        elif '/' in tokens[0]:
+            prefix, origin = tokens[0], tokens[1]
+        elif len(tokens) >= 3:
+            prefix, origin = '{}/{}'.format(tokens[0], tokens[1]), tokens[2]
+        else:
+            return None
+        # multi origin and as-set announcements, keep the first origin
+        origin = origin.strip('{}').replace('_', ',').split(',')[0]
+        if origin.upper().startswith('AS'):
+            origin = origin[2:]
+        return prefix, origin
+
+    def add(self, prefix, origin):
+        '''add a prefix to the table'''
+        network, length = prefix.split('/', 1)
+        version, value  = self._to_int(network)
+        length          = int(length)
+        bits            = self.families[version][1]
+        value           = value >> (bits - length) << (bits - length)
+        networks        = self.prefixes[version].get(length)
+        if networks is None:
+            networks = self.prefixes[version][length] = dict()
+            self.lengths[version] = sorted(self.prefixes[version], reverse=True)
+        networks[value] = (origin, prefix)
+
+    def load(self, route_file):
+        '''load a routing table dump'''
+        self.logger.info('loading routes from {}'.format(route_file))
+        count = 0
+        with self._open(route_file) as routes:
+            for line in routes:
+                entry = self._parse_line(line)
+                if entry is None:
+                    continue
+                try:
+                    self.add(*entry)
+                    count += 1
+                except (socket.error, ValueError, KeyError):
+                    self.logger.debug('skipping route line: {}'.format(line.strip()))
+        self.logger.info('loaded {} routes from {}'.format(count, route_file))
+
+    def lookup(self, address):
+        '''return the libwhois.ASNRecord of the longest matching prefix or None'''
+        try:
+            version, value = self._to_int(address)
+        except (socket.error, ValueError):
+            return None
+        bits = self.families[version][1]
+        for length in self.lengths[version]:
+            match = self.prefixes[version][length].get(value >> (bits - length) << (bits - length))
+            if match is not None:
+                origin, prefix = match
+                return libwhois.ASNRecord(origin, prefix, '', '', '', '', [])
+        return None
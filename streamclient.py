@@ -0,0 +1,117 @@
+import time
+import logging
+import urlparse
+import threading
+import socketIO_client
+
+class StreamConnection(object):
+    '''A connection to the atlas stream subscribed to a group of measurements.
+    The connection is re-established with exponential backoff and the
+    measurements re-subscribed whenever it drops.  The newest result timestamp
+    of each measurement is tracked so on_gap(measurement_id, start, stop) can
+    backfill the results missed while disconnected'''
+
+    def __init__(self, url, measurement_ids, on_result, on_gap=None, name='stream',
+            min_backoff=1, max_backoff=300):
+        '''initialise class'''
+        self.logger          = logging.getLogger('atlas-kibana.StreamConnection')
+        self.url             = url
+        # kept as strings, results carry integer msm_ids
+        self.measurement_ids = [str(measurement_id) for measurement_id in measurement_ids]
+        self.on_result       = on_result
+        self.on_gap          = on_gap
+        self.name            = name
+        self.min_backoff     = min_backoff
+        self.max_backoff     = max_backoff
+        self.lock            = threading.Lock()
+        self.stopped         = threading.Event()
+        self.last_seen       = dict()
+        self.disconnected_at = None
+        self.thread          = None
+
+    def _connect(self):
+        '''open the socket.io connection described by the url'''
+        parsed           = urlparse.urlparse(self.url)
+        prefix, resource = parsed.path.rstrip('/').rsplit('/', 1)
+        port             = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        host             = '{}://{}{}'.format(parsed.scheme or 'http', parsed.hostname, prefix)
+        return socketIO_client.SocketIO(host, port, socketIO_client.LoggingNamespace,
+                wait_for_connection=False, resource=resource)
+
+    def _result(self, result):
+        '''record the timestamp of a result and pass it on'''
+        measurement_id = str(result.get('msm_id', None))
+        timestamp      = result.get('timestamp', None)
+        if timestamp is not None:
+            with self.lock:
+                if timestamp > self.last_seen.get(measurement_id, 0):
+                    self.last_seen[measurement_id] = timestamp
+        self.on_result(result)
+
+    def _backfill(self):
+        '''report the window missed by each measurement while disconnected'''
+        if self.on_gap is None or self.disconnected_at is None:
+            return
+        now = int(time.time())
+        for measurement_id in self.measurement_ids:
+            with self.lock:
+                start = self.last_seen.get(measurement_id, None)
+            start = start + 1 if start is not None else int(self.disconnected_at)
+            if start < now:
+                self.logger.info('{}: backfilling {} from {} to {}'.format(
+                    self.name, measurement_id, start, now))
+                self.on_gap(measurement_id, start, now)
+        self.disconnected_at = None
+
+    def _run_once(self):
+        '''connect, subscribe and consume results until the connection drops'''
+        socket = self._connect()
+        try:
+            socket.on('atlas_result', self._result)
+            for measurement_id in self.measurement_ids:
+                socket.emit('atlas_subscribe', { 'stream_type': 'atlas_result', 'msm': measurement_id })
+            self.logger.info('{}: subscribed to {} measurements'.format(
+                self.name, len(self.measurement_ids)))
+            self._backfill()
+            while not self.stopped.is_set() and socket.connected:
+                socket.wait(seconds=1)
+        finally:
+            socket.disconnect()
+
+    def run(self):
+        '''consume the stream until stop() is called'''
+        backoff = self.min_backoff
+        while not self.stopped.is_set():
+            connected_at = time.time()
+            try:
+                self._run_once()
+            except Exception as e:
+                self.logger.error('{}: stream connection failed: {}'.format(self.name, e))
+            if self.stopped.is_set():
+                break
+            # a connection which stayed up for a while starts the backoff again
+            if time.time() - connected_at > self.max_backoff:
+                backoff = self.min_backoff
+            if self.disconnected_at is None:
+                self.disconnected_at = time.time()
+            self.logger.warning('{}: disconnected, reconnecting in {}s'.format(self.name, backoff))
+            self.stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def start(self):
+        '''consume the stream on a background thread'''
+        self.thread        = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''stop consuming and wait for the connection to close'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def split(measurement_ids, connections):
+    '''spread measurement ids over a number of connections'''
+    connections = max(min(connections, len(measurement_ids)), 1)
+    return [measurement_ids[index::connections] for index in range(connections)]
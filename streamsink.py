@@ -0,0 +1,117 @@
+import time
+import Queue
+import logging
+import bulkbody
+import threading
+
+class StreamSink(object):
+    '''Buffer index actions from the stream and index them on a background
+    thread.  Actions are encoded into bulk items by encode as they are added
+    and index is called with the bulk items, so each is encoded once.  The
+    buffer is flushed when it holds max_actions actions or max_bytes of
+    encoded actions, or when its oldest action is max_latency seconds old.
+    At most queue_size flushed batches wait for the indexer, after that add()
+    blocks until elasticsearch catches up'''
+
+    _stop = object()
+
+    def __init__(self, index, max_actions=200, max_bytes=5242880, max_latency=5,
+            queue_size=4, archive=None, encode=bulkbody.BulkBody.encode):
+        '''initialise class'''
+        self.logger      = logging.getLogger('atlas-kibana.StreamSink')
+        self.index       = index
+        self.encode      = encode
+        self.archive     = archive
+        self.max_actions = max_actions
+        self.max_bytes   = max_bytes
+        self.max_latency = max_latency
+        self.queue       = Queue.Queue(queue_size)
+        self.lock        = threading.Lock()
+        self._reset()
+        self.thread        = threading.Thread(target=self._worker, name='stream-sink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _reset(self):
+        '''start a new empty buffer, caller must hold the lock'''
+        self.actions = []
+        self.results = []
+        self.size    = 0
+        self.oldest  = None
+
+    def _take(self):
+        '''return the buffered (actions, results) and empty the buffer, caller must hold the lock'''
+        batch = (self.actions, self.results)
+        self._reset()
+        return batch
+
+    def _full(self):
+        '''check if the buffer should be flushed on size, caller must hold the lock'''
+        return len(self.actions) >= self.max_actions or self.size >= self.max_bytes
+
+    def _put(self, batch):
+        '''hand a batch to the indexer, blocking while the queue is full'''
+        if self.queue.full():
+            self.logger.warning('indexing is falling behind, waiting for {} queued batches'.format(
+                self.queue.qsize()))
+        self.queue.put(batch)
+
+    def add(self, actions, result=None):
+        '''buffer the index actions of one raw result'''
+        items = [self.encode(action) for action in actions]
+        with self.lock:
+            if self.oldest is None:
+                self.oldest = time.time()
+            self.actions += items
+            self.size    += sum(len(item[2]) + len(item[3]) + 2 for item in items)
+            if result is not None:
+                self.results.append(result)
+            batch = self._take() if self._full() else None
+        if batch is not None:
+            self._put(batch)
+
+    def _expired(self):
+        '''return the buffer if its oldest action is older than max_latency'''
+        with self.lock:
+            if self.oldest is not None and time.time() - self.oldest >= self.max_latency:
+                return self._take()
+        return None
+
+    def _timeout(self):
+        '''seconds until the buffer has to be flushed on latency'''
+        with self.lock:
+            if self.oldest is None:
+                return self.max_latency
+            return max(self.oldest + self.max_latency - time.time(), 0.01)
+
+    def _worker(self):
+        '''index flushed batches and flush the buffer when it gets too old'''
+        while True:
+            try:
+                batch = self.queue.get(timeout=self._timeout())
+            except Queue.Empty:
+                batch = self._expired()
+                if batch is None:
+                    continue
+            if batch is self._stop:
+                break
+            self._flush(*batch)
+
+    def _flush(self, actions, results):
+        '''archive the results of a batch and index it'''
+        try:
+            if self.archive is not None and results:
+                self.archive.write(results)
+            if actions:
+                self.index(actions)
+        except Exception as e:
+            self.logger.exception('unable to index {} actions: {}'.format(len(actions), e))
+
+    def close(self):
+        '''flush the buffer and wait for the indexer to finish'''
+        with self.lock:
+            batch = self._take()
+        self._put(batch)
+        self._put(self._stop)
+        while self.thread.is_alive():
+            self.thread.join(1)